@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''
+Round trip latency of sequential calls of a trivial consumer through RPCClient.
+
+    python -m benchmarks.latency [--calls 500] [--amqp URL]
+'''
+import time
+
+from rabbitmq_rpc.client import RPCClient
+from rabbitmq_rpc.server import RPCServer
+
+from .broker import amqp_url, argument_parser, serve
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--calls', type=int, default=500)
+    args = parser.parse_args()
+    url = amqp_url(args)
+
+    server = RPCServer(queue_name='default', amqp_url=url, threaded=True)
+
+    @server.consumer()
+    def add(a, b):
+        return a + b
+
+    serve(server)
+    client = RPCClient(amqp_url=url, queue_name='default')
+    # Warm up the connection and the callback queue
+    client.call_add(0, 0, __timeout=10)
+    durations = []
+    for i in range(args.calls):
+        start = time.perf_counter()
+        client.call_add(i, 1, __timeout=10)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    print('%d calls: p50 %.3f ms, p90 %.3f ms, p99 %.3f ms' % (
+        len(durations), percentile(durations, 0.5) * 1000, percentile(durations, 0.9) * 1000,
+        percentile(durations, 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
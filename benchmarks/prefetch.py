@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''
+Throughput of a consumer taking 2 ms per call, under concurrent calls from a shared PooledRPCClient, for several
+thread pool sizes and prefetch counts of its queue. A setting is THREADS:PREFETCH, an empty PREFETCH being the
+default of the server.
+
+    python -m benchmarks.prefetch [--calls 3000] [--clients 64] [--settings 5:1 5: 16:16] [--amqp URL]
+'''
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rabbitmq_rpc.pooled_client import PooledRPCClient
+from rabbitmq_rpc.server import RPCServer
+
+from .broker import amqp_url, argument_parser, serve
+
+
+def run(url, calls, clients, threads, prefetch_count):
+    queue_name = 'prefetch-%d-%s' % (threads, prefetch_count)
+    settings = {'num_threads': threads}
+    if prefetch_count is not None:
+        settings['prefetch_count'] = prefetch_count
+    server = RPCServer(queue_name=queue_name, amqp_url=url, threaded=True, queue_settings={queue_name: settings})
+
+    @server.consumer()
+    def work(i):
+        time.sleep(0.002)
+        return i
+
+    serve(server)
+    client = PooledRPCClient(amqp_url=url, queue_name=queue_name)
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(clients) as executor:
+            results = list(executor.map(lambda i: client.call_work(i, __timeout=60), range(calls)))
+        duration = time.time() - start
+    finally:
+        client.close()
+    assert results == list(range(calls))
+    queue = server._queues[queue_name]
+    print('%3d threads, prefetch %3d: %5d msgs/s' % (
+        queue.dispatcher.threadpool_size, queue.prefetch_count, calls / duration))
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--calls', type=int, default=3000)
+    parser.add_argument('--clients', type=int, default=64, help='Threads calling concurrently')
+    parser.add_argument('--settings', nargs='+', default=['5:1', '5:', '16:16'], metavar='THREADS:PREFETCH')
+    args = parser.parse_args()
+    url = amqp_url(args)
+    for setting in args.settings:
+        threads, prefetch_count = setting.split(':')
+        run(url, args.calls, args.clients, int(threads), int(prefetch_count) if prefetch_count else None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''
+Throughput and peak memory of the pickle and pickle5 serializers on float64 NumPy arrays. A request is encoded and
+decoded, then its result is encoded and decoded again, as in a call echoing its argument. Each serializer and size
+runs in a process of its own, so the peak RSS is its own. Needs numpy.
+
+Only the serializers are timed, in process: publishing and receiving through the broker is not, and on that path
+pickle5 saves a copy on the receiving side only.
+
+    python -m benchmarks.serializers [--sizes 1 64 256] [--serializers pickle pickle5]
+'''
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+ROUNDS = 3
+
+
+def run(name, megabytes):
+    import numpy
+
+    from rabbitmq_rpc import serializers
+
+    serializer = serializers.get_serializer(name)
+    array = numpy.random.rand(megabytes * 1024 * 1024 // 8)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        request = serializer.loads(serializer.dumps({'args': (array,), 'kwargs': {}}))
+        result = serializer.loads(serializer.dumps(request['args'][0]))
+    duration = (time.perf_counter() - start) / ROUNDS
+    assert numpy.array_equal(result, array)
+    # ru_maxrss is in KB on Linux
+    print('%-8s %4d MB: %5.0f MB/s, peak RSS %5d MB' % (
+        name, megabytes, megabytes / duration, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 64, 256], help='Array sizes in MB')
+    parser.add_argument('--serializers', nargs='+', default=['pickle', 'pickle5'])
+    parser.add_argument('--run', nargs=2, metavar=('SERIALIZER', 'MB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run(args.run[0], int(args.run[1]))
+        return
+    for megabytes in args.sizes:
+        for name in args.serializers:
+            subprocess.check_call([sys.executable, '-m', 'benchmarks.serializers', '--run', name, str(megabytes)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''
+Throughput of a trivial consumer under concurrent calls from a shared PooledRPCClient, and the number of ack frames
+the server sent for them. The 'baseline' mode runs the server with the handoff the outbox replaced: every reply and
+every ack takes a process-wide lock and schedules an add_callback_threadsafe of its own.
+
+    python -m benchmarks.throughput [--calls 5000] [--clients 64] [--threads 1 8 64] [--modes baseline outbox]
+                                    [--amqp URL]
+'''
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from rabbitmq_rpc.outbox import ReplyOutbox
+from rabbitmq_rpc.pooled_client import PooledRPCClient
+from rabbitmq_rpc.server import RPCServer
+
+from .broker import amqp_url, argument_parser, serve
+
+
+class CallbackOutbox(ReplyOutbox):
+    '''
+    The handoff of replies and acks before ReplyOutbox: one ioloop callback per item, scheduled under a lock shared
+    by every dispatcher, and one basic_ack per delivery.
+    '''
+    _lock = threading.Lock()
+
+    def delivered(self, delivery_tag):
+        pass
+
+    def publish(self, exchange, routing_key, properties, body):
+        with self._lock:
+            self._connection.ioloop.add_callback_threadsafe(
+                partial(self._publish, exchange, routing_key, body, properties))
+
+    def ack(self, delivery_tag):
+        with self._lock:
+            self._connection.ioloop.add_callback_threadsafe(partial(self._ack, delivery_tag))
+
+    def _publish(self, *args):
+        self._channel.basic_publish(*args)
+        self.replies += 1
+
+    def _ack(self, delivery_tag):
+        self._channel.basic_ack(delivery_tag)
+        self.acks += 1
+        self.ack_frames += 1
+
+
+class BaselineRPCServer(RPCServer):
+
+    def _setup_queue(self, queue_name):
+        if self._outbox is None:
+            self._outbox = CallbackOutbox(self._connection, self._channel, self._threaded)
+        return super(BaselineRPCServer, self)._setup_queue(queue_name)
+
+
+SERVERS = {'baseline': BaselineRPCServer, 'outbox': RPCServer}
+
+
+def run(url, calls, clients, threads, mode):
+    queue_name = 'throughput-%s-%d' % (mode, threads)
+    server = SERVERS[mode](queue_name=queue_name, amqp_url=url, threaded=True, num_threads=threads)
+
+    @server.consumer()
+    def add(a, b):
+        return a + b
+
+    serve(server)
+    client = PooledRPCClient(amqp_url=url, queue_name=queue_name)
+    try:
+        start = time.time()
+        with ThreadPoolExecutor(clients) as executor:
+            results = list(executor.map(lambda i: client.call_add(i, 1, __timeout=60), range(calls)))
+        duration = time.time() - start
+    finally:
+        client.close()
+    assert results == [i + 1 for i in range(calls)]
+    stats = server._outbox.stats()
+    print('%-8s %3d threads: %5d msgs/s, %d acks in %d ack frames' % (
+        mode, threads, calls / duration, stats['acks'], stats['ack_frames']))
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--calls', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=64, help='Threads calling concurrently')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 64], help='Worker threads of the server')
+    parser.add_argument('--modes', nargs='+', default=['baseline', 'outbox'], choices=sorted(SERVERS))
+    args = parser.parse_args()
+    url = amqp_url(args)
+    for threads in args.threads:
+        for mode in args.modes:
+            run(url, args.calls, args.clients, threads, mode)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@ import logging
 import sys
 
 from .client import RPCClient
+from .async_client import AsyncRPCClient
+from .pooled_client import PooledRPCClient
 from .server import RPCServer
 from .consumer import consumer, Consumer
 from .credentials import AliyunCredentialsProvider
@@ -12,13 +14,14 @@ LOG_FORMAT = (
 logging.basicConfig(level=logging.WARNING, format=LOG_FORMAT)
 
 __all__ = [
-    'consumer', 'Consumer', 'RPCClient', 'RPCServer',
+    'consumer', 'Consumer', 'RPCClient', 'AsyncRPCClient',
+    'PooledRPCClient', 'RPCServer',
     'AliyunCredentialsProvider'
 ]
 
 
 def main():
-    from rabbit_rpc.commands import ManageUtility
+    from rabbitmq_rpc.commands import ManageUtility
     manage = ManageUtility(sys.argv)
     manage.execute()
 
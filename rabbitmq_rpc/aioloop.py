@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''
+The asyncio event loop of the coroutine (async def) consumers. It runs on a thread of its own, so a coroutine waiting
+for I/O holds no thread of the pool, and thousands of calls can be in progress at once.
+'''
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread(object):
+    '''
+    An asyncio event loop on a daemon thread, started by the first submit().
+    Parameters:
+        concurrency: Max number of coroutines running at once. The others wait for a slot on the loop.
+    '''
+    def __init__(self, concurrency=100):
+        self.concurrency = concurrency
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        # Updated on the loop thread only
+        self.running = 0
+        # Updated by the dispatcher threads, under _lock
+        self.submitted = 0
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run, args=(self._loop,), name='rabbitmq_rpc-asyncio')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, loop):
+        # stop() clears self._loop before the loop returns
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop. Thread-safe.
+
+        :rtype: concurrent.futures.Future, resolved on the loop thread
+
+        """
+        self.start()
+        with self._lock:
+            self.submitted += 1
+        return asyncio.run_coroutine_threadsafe(self._limited(coro), self._loop)
+
+    def run(self, coro):
+        """Run a coroutine on the loop and wait for its result. Must not be
+        called from the loop thread.
+
+        """
+        return self.submit(coro).result()
+
+    async def _limited(self, coro):
+        if self._semaphore is None:
+            # Created on the loop, so it's bound to it
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            self.running += 1
+            try:
+                return await coro
+            finally:
+                self.running -= 1
+
+    def stop(self):
+        """Stop the loop. Coroutines still running are abandoned."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+            thread, self._thread = self._thread, None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            submitted = self.submitted
+        return {
+            'submitted': submitted,
+            'running': self.running,
+            'concurrency': self.concurrency,
+        }
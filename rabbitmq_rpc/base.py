@@ -21,6 +21,7 @@ class Connector(object):
     '''
     DEFUALT_QUEUE = 'default'
     EXCHANGE_TYPE = 'direct'
+    DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
     def __init__(self, amqp_url=None,
                  host = "localhost", port = 5672, prefetch_count = 1,
                  username = "guest", passwd="guest", exchange='default', threaded = True, auto_delete = True, durable = False,
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+'''
+Result cache of consumers. Calls are keyed by a canonical hash of their decoded arguments, so equal arguments hit
+the same entry whatever the serializer, the dict ordering or list vs tuple.
+'''
+import collections
+import hashlib
+import pickle
+import threading
+import time
+
+_PRIMITIVES = (type(None), bool, int, float, complex, str, bytes)
+
+
+def _canonical(obj):
+    if isinstance(obj, _PRIMITIVES):
+        return obj
+    if isinstance(obj, dict):
+        items = [(repr(_canonical(k)), _canonical(v)) for k, v in obj.items()]
+        items.sort(key=lambda item: item[0])
+        return ('dict', tuple(items))
+    if isinstance(obj, (list, tuple)):
+        return ('seq', tuple(_canonical(item) for item in obj))
+    if isinstance(obj, (set, frozenset)):
+        return ('set', tuple(sorted(repr(_canonical(item)) for item in obj)))
+    # Anything else is compared by its pickled state
+    return ('obj', pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def canonical_key(args, kwargs):
+    """A hash of the arguments of a call, equal for equal arguments.
+
+    :raises Exception: The arguments can't be hashed, e.g. unpicklable objects
+
+    """
+    data = repr((_canonical(args), _canonical(kwargs))).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def request_key(content_type, content_encoding, body):
+    """A hash of a raw request body and its encoding, to find the cached
+    result of a request before it's decoded, see ResultCache.alias.
+
+    """
+    digest = hashlib.sha1(('%s\0%s\0' % (content_type, content_encoding)).encode('utf-8'))
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    '''
+    A LRU cache of consumer results.
+    Parameters:
+        maxsize: Max number of entries. None, no limit.
+        maxbytes: Max total size of the entries, measured as the pickled size of the results plus the size of the
+            values of their aliases. None, no limit.
+        ttl: Seconds an entry is valid for. None, until evicted or invalidated.
+    '''
+    def __init__(self, maxsize=1024, maxbytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        # Other keys of the entries, see alias(): alias -> (key, value, size), and key -> set of aliases
+        self._aliases = {}
+        self._aliases_of = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @classmethod
+    def create(cls, cache):
+        """Build the cache of a consumer from its cache option: True, a dict of
+        ResultCache parameters or a ResultCache.
+
+        """
+        if not cache:
+            return None
+        if isinstance(cache, ResultCache):
+            return cache
+        if cache is True:
+            return cls()
+        return cls(**cache)
+
+    def get(self, key):
+        """Look key up.
+
+        :rtype: tuple(bool, result): Whether it was found, and its result
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def get_alias(self, alias):
+        """Look an entry up by one of its aliases. A miss isn't counted, as the
+        lookup by key follows it.
+
+        :rtype: tuple(bool, value): Whether it was found, and the value of the
+                alias
+
+        """
+        with self._lock:
+            aliased = self._aliases.get(alias)
+        if aliased is None or not self.get(aliased[0])[0]:
+            return False, None
+        return True, aliased[1]
+
+    def alias(self, alias, key, value=None, size=0):
+        """Make alias another key of the entry of key, if it's cached. The
+        alias is dropped with the entry.
+
+        :param value: Returned by get_alias instead of the result, e.g. the
+                      result already encoded
+        :param int size: Bytes of value, counted in maxbytes
+
+        """
+        with self._lock:
+            if key in self._entries and alias not in self._aliases:
+                self._aliases[alias] = (key, value, size)
+                self._aliases_of.setdefault(key, set()).add(alias)
+                self._bytes += size
+                self._evict()
+
+    def put(self, key, value, ttl=None):
+        """Cache value under key. ttl overrides the ttl of the cache."""
+        if ttl is None:
+            ttl = self.ttl
+        size = 0
+        if self.maxbytes is not None:
+            try:
+                size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            except Exception:
+                return
+            if size > self.maxbytes:
+                return
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, size, value)
+            self._bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._entries and ((self.maxsize is not None and len(self._entries) > self.maxsize) or
+                                 (self.maxbytes is not None and self._bytes > self.maxbytes)):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[1]
+        for alias in self._aliases_of.pop(key, ()):
+            self._bytes -= self._aliases.pop(alias)[2]
+
+    def invalidate(self, key=None):
+        """Drop the entry of key, or every entry if key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._aliases.clear()
+                self._aliases_of.clear()
+                self._bytes = 0
+            elif key in self._entries:
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
@@ -1,19 +1,366 @@
 # -*- coding: utf-8 -*-
+import abc
+import collections
+import contextvars
+import itertools
 import logging
 import time
 import uuid
 
 import pika
+import six
 from .base import Connector
-import pickle
-import json
+from . import serializers
+from .compression import Compressor
+from .upload import split_body
+from .cache import ResultCache, canonical_key
+from .metrics import CallTiming, ClientMetrics
 
-from .exceptions import (ERROR_FLAG, HAS_ERROR, NO_ERROR, RemoteFunctionError,
-                         RemoteCallTimeout)
+from .exceptions import (ERROR_FLAG, HAS_ERROR, NO_ERROR, BATCH_FLAG, STREAM_FLAG, STREAM_SEQ, STREAM_END, MAX_AGE,
+                         DEADLINE, SENT_AT, RECV_AT, RemoteFunctionError, RemoteCallTimeout)
 
 logger = logging.getLogger(__name__)
 
-class RPCClient(Connector):
+
+class StreamBuffer(object):
+    '''
+    Puts the replies of a stream back in sequence order. A reply without stream headers, e.g. an error sent
+    before the stream started, ends the stream.
+    '''
+    def __init__(self):
+        self._pending = {}
+        self._next = 0
+
+    def push(self, props, body):
+        headers = props.headers or {}
+        if STREAM_SEQ in headers:
+            self._pending[headers[STREAM_SEQ]] = (bool(headers.get(STREAM_END)), props, body)
+        else:
+            self._pending[self._next] = (True, props, body)
+
+    def pop(self):
+        """The next reply in sequence, (is_end, props, body), or None if it
+        hasn't arrived yet.
+
+        """
+        item = self._pending.pop(self._next, None)
+        if item is not None:
+            self._next += 1
+        return item
+
+
+@six.add_metaclass(abc.ABCMeta)
+class BaseRPCClient(Connector):
+    '''
+    Shared part of the RPC clients: body encoding, reply decoding and the call_<name> / call() surface.
+    Subclasses implement call(), publish_message and the way a reply is waited for.
+    Parameters: See RPCClient
+    '''
+    def __init__(self, bDataJson = False, queue_name = "", direct_reply_to = False, serializer = None,
+                 compress_threshold = None, compress_level = 6, upload_chunk_size = None, timing_hook = None,
+                 **kwargs):
+        self._results = {}
+        self.callback_queue = None
+        self.bDataJson = bDataJson
+        if serializer is None:
+            serializer = 'json' if bDataJson else serializers.DEFAULT_SERIALIZER
+        self.serializer = serializers.get_serializer(serializer)
+        self.compressor = Compressor(compress_threshold, compress_level)
+        self.direct_reply_to = direct_reply_to
+        self.upload_chunk_size = upload_chunk_size
+        # Response caches by consumer name, see cache()
+        self._caches = {}
+        # Round trip times per remote function, see metrics.py
+        self.metrics = ClientMetrics()
+        # max-age header of the replies awaited for a response cache, by correlation id
+        self._cache_max_ages = {}
+        # CallTiming of the replies awaited, by correlation id, see last_timing
+        self._timings = {}
+        # Of the current thread, or asyncio task: a thread-local would be shared by the tasks of an event loop
+        self._last_timing = contextvars.ContextVar('last_timing', default=None)
+        self.timing_hook = timing_hook
+        self._local_queues = []
+        self.queue_name = queue_name
+        super(BaseRPCClient, self).__init__(**kwargs)
+
+    def setup_exchange(self, exchange_name):
+        if self.direct_reply_to:
+            # The exchange is declared by the server, nothing to declare here.
+            self.on_exchange_declareok(None)
+        else:
+            super(BaseRPCClient, self).setup_exchange(exchange_name)
+
+    def get_serializer(self, serializer=None):
+        if serializer is None:
+            return self.serializer
+        return serializers.get_serializer(serializer)
+
+    def decode_response(self, props, body):
+        """Decode a reply body with the serializer named by its content_type. If
+        the server flagged the reply as an error, a RemoteFunctionError is
+        returned instead of the value.
+
+        """
+        body = self.compressor.decompress(body, props.content_encoding)
+        ret = serializers.find_serializer(props.content_type, self.serializer).loads(body)
+        headers = props.headers or {}
+        if RECV_AT in headers and props.correlation_id in self._timings:
+            self._timings[props.correlation_id] = CallTiming.from_headers(headers, time.time(), props.correlation_id)
+        if headers.get(ERROR_FLAG, NO_ERROR) == HAS_ERROR:
+            ret = RemoteFunctionError(ret)
+        elif MAX_AGE in headers and props.correlation_id in self._cache_max_ages:
+            self._cache_max_ages[props.correlation_id] = headers[MAX_AGE] / 1000.0
+        return ret
+
+    @property
+    def last_timing(self):
+        """metrics.CallTiming of the last call of the current thread or asyncio
+        task that got a reply with timing headers, or None.
+
+        """
+        return self._last_timing.get()
+
+    def report_timing(self, consumer_name, correlation_id):
+        """Publish the timing of an answered call to last_timing and to the
+        timing hook.
+
+        """
+        timing = self._timings.pop(correlation_id, None)
+        if timing is None:
+            return
+        timing.function = consumer_name
+        self._last_timing.set(timing)
+        if self.timing_hook is not None:
+            try:
+                self.timing_hook(timing)
+            except Exception:
+                logger.exception('Timing hook failed.')
+
+    def cache(self, consumer_name, ttl=None, maxsize=1024, maxbytes=None):
+        """Cache the results of a remote function locally. A call whose
+        arguments were called before is answered from the cache, without any
+        round trip. Stream calls and calls ignoring the result are never cached.
+
+        :param str consumer_name: The remote function
+        :param float ttl: Seconds a result is valid for. A max-age sent by the
+                          server (see the consumer's max_age) takes precedence.
+                          None, until evicted or invalidated.
+        :param int maxsize: Max number of cached results, the least recently
+                            used one is evicted first
+        :param int maxbytes: Max pickled size of all the cached results
+        :rtype: cache.ResultCache
+
+        """
+        self._caches[consumer_name] = ResultCache(maxsize, maxbytes, ttl)
+        return self._caches[consumer_name]
+
+    def uncache(self, consumer_name):
+        """Stop caching the results of a remote function."""
+        self._caches.pop(consumer_name, None)
+
+    def invalidate_cache(self, consumer_name=None):
+        """Drop the cached results of a remote function, or of every one if
+        consumer_name is None.
+
+        """
+        for name, cache in list(self._caches.items()):
+            if consumer_name is None or name == consumer_name:
+                cache.invalidate()
+
+    def cache_stats(self):
+        """Response cache counters, keyed by remote function name."""
+        return dict((name, cache.stats()) for name, cache in self._caches.items())
+
+    def cache_key(self, consumer_name, args, kwargs, options):
+        """The response cache key of a call, or None if it isn't cached."""
+        if consumer_name not in self._caches or options['ignore_result'] or options['stream']:
+            return None
+        try:
+            return canonical_key((options['exchange'], options['routing_key'], args), kwargs)
+        except Exception:
+            return None
+
+    def store_cached(self, consumer_name, key, ret, max_age=None):
+        """Cache the result of a call, unless it's an error or the server sent
+        a max-age of 0.
+
+        """
+        cache = self._caches.get(consumer_name)
+        if cache is None or isinstance(ret, RemoteFunctionError) or max_age == 0:
+            return
+        cache.put(key, ret, ttl=max_age)
+
+    def pop_call_options(self, kwargs):
+        """Pop the '__' prefixed call options out of the keyword arguments of a
+        remote call.
+
+        :param dict kwargs: keyword arguments passed to call_<name>
+        :rtype: dict
+
+        """
+        options = {
+            'ignore_result': kwargs.pop('__ignore_result', False),
+            'exchange': kwargs.pop('__exchange', self._exchange),
+            'routing_key': kwargs.pop('__routing_key', self.queue_name),
+            'timeout': kwargs.pop('__timeout', None),
+            'serializer': kwargs.pop('__serializer', None),
+            'stream': kwargs.pop('__stream', False),
+            'priority': kwargs.pop('__priority', None),
+        }
+        try:
+            if options['timeout'] is not None:
+                options['timeout'] = float(options['timeout'])
+        except (ValueError, TypeError):
+            raise ValueError("'timeout' is expected a float.")
+        try:
+            if options['priority'] is not None:
+                options['priority'] = int(options['priority'])
+        except (ValueError, TypeError):
+            raise ValueError("'priority' is expected an int.")
+        # The server drops the request once the caller gave up. The timeout of a stream is per chunk, so it has none.
+        options['deadline'] = None
+        if options['timeout'] is not None and not options['stream']:
+            options['deadline'] = time.time() + options['timeout']
+        return options
+
+    def split_request(self, body, headers):
+        """Split an encoded request into the messages to publish, and stamp
+        them with the publish time.
+
+        :rtype: list of (body, headers)
+
+        """
+        headers = dict(headers or {})
+        headers[SENT_AT] = int(time.time() * 1000000)
+        messages = []
+        for chunk, upload_headers in split_body(body, self.upload_chunk_size):
+            if upload_headers is not None:
+                upload_headers.update(headers or {})
+                messages.append((chunk, upload_headers))
+            else:
+                messages.append((chunk, headers))
+        return messages
+
+    def request_headers(self, consumer_name, options):
+        headers = {'consumer_name': consumer_name}
+        if options['stream']:
+            headers[STREAM_FLAG] = 1
+        if options.get('deadline') is not None:
+            headers[DEADLINE] = int(options['deadline'] * 1000)
+        return headers
+
+    def request_expiration(self, headers, messages):
+        """The AMQP expiration of a request with a deadline, so the broker
+        drops it when it's still queued after the deadline. Chunked requests
+        have none: a chunk dropped by the broker would stall the whole upload.
+
+        :param list messages: The messages of the request, see split_request
+        :rtype: str or None
+
+        """
+        deadline = (headers or {}).get(DEADLINE)
+        if deadline is None or len(messages) > 1:
+            return None
+        return str(max(deadline - int(time.time() * 1000), 0))
+
+    def iter_stream(self, next_reply, timeout=None):
+        """Yield the chunks of a streamed result as they arrive.
+
+        :param callable next_reply: timeout -> (props, body) of the next reply
+                                    received for the stream
+        :param float timeout: Timeout of waiting for each chunk
+
+        """
+        buffer = StreamBuffer()
+        while True:
+            item = buffer.pop()
+            if item is None:
+                buffer.push(*next_reply(timeout))
+                continue
+            is_end, props, body = item
+            ret = self.decode_response(props, body)
+            if isinstance(ret, RemoteFunctionError):
+                raise ret
+            if is_end:
+                return
+            yield ret
+
+    @abc.abstractmethod
+    def call(self, consumer_name):
+        """The function calling the remote function consumer_name, returned for
+        client.call_<consumer_name>.
+
+        """
+
+    def publish_batches(self, consumer_name, iterable, chunk_size, options):
+        """Publish the items of iterable as batch requests of chunk_size calls.
+        Items that are tuples are passed as positional arguments, any other item
+        as the only argument.
+
+        :rtype: list of correlation ids, one per batch
+
+        """
+        chunk_size = max(int(chunk_size), 1)
+        items = iter(iterable)
+        corr_ids = []
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                return corr_ids
+            calls = [{'args': item if isinstance(item, tuple) else (item,), 'kwargs': {}} for item in chunk]
+            corr_ids.append(self.publish_message(
+                options['exchange'],
+                options['routing_key'],
+                body={'batch': calls},
+                headers=dict(self.request_headers(consumer_name, options), **{BATCH_FLAG: 1}),
+                serializer=options['serializer'],
+                priority=options['priority']))
+
+    def unpack_batch(self, consumer_name, ret):
+        if isinstance(ret, RemoteFunctionError):
+            raise ret
+        return [RemoteFunctionError(value) if is_error else value for is_error, value in ret]
+
+    def map(self, consumer_name, iterable, chunk_size=100, **kwargs):
+        """Call the remote function once for every item of iterable. chunk_size
+        calls are packed into one message, so len(iterable) / chunk_size round
+        trips are needed instead of len(iterable), and all the batches are in
+        flight at the same time.
+
+        :param str consumer_name: The remote function
+        :param iterable: Arguments of every call. A tuple item is passed as
+                         positional arguments, any other item as the only one.
+        :param int chunk_size: Number of calls per message
+        :param float __timeout: Timeout of the whole map
+        :return: The list of results in input order. A call that failed on the
+                 server is a RemoteFunctionError at its position.
+
+        """
+        options = self.pop_call_options(kwargs)
+        stoploop = time.time() + options['timeout'] if options['timeout'] is not None else None
+        corr_ids = self.publish_batches(consumer_name, iterable, chunk_size, options)
+        logger.info('Sent %d batches of remote call: %s', len(corr_ids), consumer_name)
+
+        results = []
+        for corr_id in corr_ids:
+            timeout = max(stoploop - time.time(), 0) if stoploop is not None else None
+            try:
+                ret = self.get_response(corr_id, timeout)
+            except RemoteCallTimeout:
+                raise RemoteCallTimeout(
+                    "Calling remote function '%s' timeout." % consumer_name)
+            results.extend(self.unpack_batch(consumer_name, ret))
+        return results
+
+    def __getattribute__(self, key):
+        if key.startswith('call_'):
+            _, consumer_name = key.split('call_')
+            return self.call(consumer_name)
+
+        return super(BaseRPCClient, self).__getattribute__(key)
+
+
+class RPCClient(BaseRPCClient):
     '''
     RPC client.
     Parameters:
@@ -28,22 +375,41 @@ class RPCClient(Connector):
         queue_name: queue name you want to connect. If not setted, the queue name will be allocated randomly.
         bDataJson: Whether your data will be transmitted in json. If setted to false, the data will be transmitted with pickle.
             This flag should be set if the RPCServer also set to True, otherwise, leave it default.
+        serializer: name or content_type of the serializer used to encode requests, see serializers.py. 'pickle', 'json'
+            and 'msgpack'(if installed) are builtin. Default 'json' if bDataJson else 'pickle'. It can be changed per
+            call with the '__serializer' option. The server replies in the same format.
+        compress_threshold: Requests larger than compress_threshold bytes are compressed with zlib. Default None, no
+            compression. Compressed replies are always accepted. See client.compressor.stats() for the counters.
+        compress_level: zlib compression level.
+        upload_chunk_size: Requests larger than upload_chunk_size bytes, after compression, are uploaded in chunks of
+            upload_chunk_size bytes and reassembled by the server. Default None, never split. Every chunk must reach
+            the same server, see upload.py.
+        direct_reply_to: If True, replies are consumed from RabbitMQ's 'amq.rabbitmq.reply-to' pseudo-queue. The client
+            then declares nothing on the server: no callback queue, no binding and no exchange. So the exchange must
+            have been declared by the RPCServer already.
+        timing_hook: Called with the metrics.CallTiming of every call answered with timing headers, e.g. to forward
+            it to a tracing backend. The last one of each thread or asyncio task is also available as
+            client.last_timing.
     '''
-    def __init__(self, bDataJson = False, queue_name = "",**kwargs):
-        self._results = {}
-        self.callback_queue = None
-        self.bDataJson = bDataJson
-        self._local_queues = []
-        self.queue_name = queue_name
-        super(RPCClient, self).__init__(**kwargs)
+    def __init__(self, bDataJson = False, queue_name = "", direct_reply_to = False, **kwargs):
+        super(RPCClient, self).__init__(bDataJson=bDataJson, queue_name=queue_name, direct_reply_to=direct_reply_to,
+                                        **kwargs)
+        self._streams = {}
         self._threaded = False # Force threaded flag to false
         self._connection = self.connect()
         self._channel = self._connection.channel()
-        self._channel.exchange_declare(self._exchange, exchange_type='direct', auto_delete=self.auto_delete, durable=self.durable)
+        if not self.direct_reply_to:
+            self._channel.exchange_declare(self._exchange, exchange_type='direct', auto_delete=self.auto_delete,
+                                           durable=self.durable)
         self.setup_callback_queue()
 
     def setup_callback_queue(self):
-        if not self.callback_queue:
+        if not self.callback_queue and self.direct_reply_to:
+            self.callback_queue = self.DIRECT_REPLY_TO
+            self._channel.basic_consume(self.callback_queue,
+                                       self.on_response,
+                                       auto_ack=True)
+        elif not self.callback_queue:
             # if len(self.queue_name):
             #     ret = self._channel.queue_declare(queue=self.queue_name, exclusive=False, auto_delete=self.auto_delete,
             #                                       durable=self.durable)
@@ -56,44 +422,75 @@ class RPCClient(Connector):
                                        auto_ack=True)
 
     def on_response(self, channel, basic_deliver, props, body):
-        if self.bDataJson:
-            ret = json.loads(body.decode('utf-8'))
-        else:
-            ret = pickle.loads(body)
-        if props.headers.get(ERROR_FLAG, NO_ERROR) == HAS_ERROR:
-            ret = RemoteFunctionError(ret)
-        self._results[props.correlation_id] = ret
+        if props.correlation_id in self._streams:
+            self._streams[props.correlation_id].append((props, body))
+        elif STREAM_SEQ not in (props.headers or {}):
+            self._results[props.correlation_id] = self.decode_response(props, body)
+
+    def wait_for(self, predicate, timeout=None):
+        """Process events until predicate() is true. process_data_events blocks
+        on the socket until the broker sends something (or the remaining time
+        runs out), so it returns as soon as the awaited reply has been
+        dispatched to on_response.
+
+        """
+        stoploop = time.time() + timeout if timeout is not None else None
+        while not predicate():
+            if stoploop is None:
+                time_limit = None
+            else:
+                time_limit = stoploop - time.time()
+                if time_limit <= 0:
+                    raise RemoteCallTimeout()
+            self._connection.process_data_events(time_limit=time_limit)
 
     def get_response(self, correlation_id, timeout=None):
-        stoploop = time.time() + timeout if timeout is not None else 0
-        while stoploop > time.time() or timeout is None:
-            self._connection.process_data_events()
-            if correlation_id in self._results:
-                return self._results.pop(correlation_id)
-            self._connection.sleep(0.01)
+        """Wait for the reply of correlation_id."""
+        self.wait_for(lambda: correlation_id in self._results, timeout)
+        return self._results.pop(correlation_id)
+
+    def get_stream(self, correlation_id, timeout=None):
+        """Iterate over the chunks of a streamed reply."""
+        replies = self._streams[correlation_id]
 
-        raise RemoteCallTimeout()
+        def next_reply(timeout):
+            self.wait_for(lambda: replies, timeout)
+            return replies.popleft()
 
+        try:
+            for chunk in self.iter_stream(next_reply, timeout):
+                yield chunk
+        finally:
+            self._streams.pop(correlation_id, None)
 
-    def publish_message(self, exchange, routing_key, body, ignore_result = False, headers=None):
+
+    def publish_message(self, exchange, routing_key, body, ignore_result = False, headers=None, serializer=None,
+                        stream=False, priority=None):
+        serializer = self.get_serializer(serializer)
         corr_id = str(uuid.uuid4())
         rply_to = None
         if not ignore_result:
             rply_to = self.callback_queue
-        if self.bDataJson:
-            body = json.dumps(body).encode('utf-8')
-        else:
-            body = pickle.dumps(body)
-
-        self._channel.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
-            properties=pika.BasicProperties(
-                reply_to=rply_to,
-                headers=headers,
-                correlation_id=corr_id,
-            ),
-            body=body)
+            if stream:
+                self._streams[corr_id] = collections.deque()
+        body, content_encoding = self.compressor.compress(serializer.dumps(body))
+
+        messages = self.split_request(body, headers)
+        expiration = self.request_expiration(headers, messages)
+        for chunk, chunk_headers in messages:
+            self._channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                properties=pika.BasicProperties(
+                    reply_to=rply_to,
+                    headers=chunk_headers,
+                    correlation_id=corr_id,
+                    content_type=serializer.content_type,
+                    content_encoding=content_encoding,
+                    expiration=expiration,
+                    priority=priority,
+                ),
+                body=chunk)
 
         return corr_id
 
@@ -110,39 +507,61 @@ class RPCClient(Connector):
             :param str routing_key: The routing key to bind on.
             :param float timeout: if waiting the result over timeount seconds,
                                   RemoteCallTimeout will be raised .
+            :param str serializer: serializer name of this call.
+            :param bool stream: Return an iterator over the chunks yielded by a
+                                generator consumer, as they arrive. timeout
+                                then applies to the wait for each chunk.
+            :param int priority: AMQP priority of the request, see the
+                                 max_priority of the server's queues.
             """
-            ignore_result = kwargs.pop('__ignore_result', False)
-            exchange = kwargs.pop('__exchange', self._exchange)
-            routing_key = kwargs.pop('__routing_key', self.queue_name)
-            timeout = kwargs.pop('__timeout', None)
+            options = self.pop_call_options(kwargs)
+            ignore_result = options['ignore_result']
+            timeout = options['timeout']
+            key = self.cache_key(consumer_name, args, kwargs, options)
+            if key is not None:
+                found, ret = self._caches[consumer_name].get(key)
+                if found:
+                    return ret
 
             if not ignore_result:
                 self.setup_callback_queue()
 
-            try:
-                if timeout is not None:
-                    timeout = float(timeout)
-            except (ValueError, TypeError):
-                raise ValueError("'timeout' is expected a float.")
-
             payload = {
                 'args': args,
                 'kwargs': kwargs,
             }
+            start = time.perf_counter()
             corr_id = self.publish_message(
-                exchange,
-                routing_key,
+                options['exchange'],
+                options['routing_key'],
                 body=payload,
                 ignore_result = ignore_result,
-                headers={'consumer_name': consumer_name})
+                headers=self.request_headers(consumer_name, options),
+                serializer=options['serializer'],
+                stream=options['stream'],
+                priority=options['priority'])
 
-            logger.info('Sent remote call: %s', consumer_name)
+            logger.debug('Sent remote call: %s', consumer_name)
+            if not ignore_result and options['stream']:
+                return self.get_stream(corr_id, timeout)
             if not ignore_result:
+                if key is not None:
+                    self._cache_max_ages[corr_id] = None
+                self._timings[corr_id] = None
+                # Whatever the call raises counts as an error
+                is_error = True
                 try:
                     ret = self.get_response(corr_id, timeout)
+                    is_error = isinstance(ret, RemoteFunctionError)
                 except RemoteCallTimeout:
                     raise RemoteCallTimeout(
                         "Calling remote function '%s' timeout." % consumer_name)
+                finally:
+                    self.metrics.observe(consumer_name, time.perf_counter() - start, is_error)
+                    max_age = self._cache_max_ages.pop(corr_id, None)
+                    self.report_timing(consumer_name, corr_id)
+                if key is not None:
+                    self.store_cached(consumer_name, key, ret, max_age)
 
                 if isinstance(ret, RemoteFunctionError):
                     raise ret
@@ -154,13 +573,6 @@ class RPCClient(Connector):
         func.__name__ = consumer_name
         return func
 
-    def __getattribute__(self, key):
-        if key.startswith('call_'):
-            _, consumer_name = key.split('call_')
-            return self.call(consumer_name)
-
-        return super(RPCClient, self).__getattribute__(key)
-
     def __del__(self):
         pass
         # if not self._connection.:
@@ -10,9 +10,10 @@ import traceback
 
 import pika
 
-from rabbit_rpc.consumer import Consumer
-from rabbit_rpc.credentials import AliyunCredentialsProvider
-from rabbit_rpc.server import RPCServer
+from rabbitmq_rpc.consumer import Consumer
+from rabbitmq_rpc.credentials import AliyunCredentialsProvider
+from rabbitmq_rpc.prefork import Prefork
+from rabbitmq_rpc.server import RPCServer
 from .base import BaseCommand
 
 logger = logging.getLogger(__name__)
@@ -40,6 +41,17 @@ class Worker(BaseCommand):
 
             [access_key]:[access_secret]:[resource_owner_id]
             ''')
+        parser.add_argument(
+            '-P',
+            '--processes',
+            type=int,
+            default=1,
+            help='pre-fork this number of worker processes, each with its own connection')
+        parser.add_argument(
+            '--max-requests',
+            type=int,
+            default=None,
+            help='replace a worker process after it served this number of requests')
 
     def install_django(self, project_name):
         import django
@@ -101,9 +113,25 @@ class Worker(BaseCommand):
                 sys.stderr.write('No consumer was detected.\n')
                 sys.exit(1)
 
-            server = RPCServer(
-                consumers = consumers, conn_parameters=conn_parameters,
-                queue_name=options['queue'])
+            prefork = options['processes'] > 1 or options['max_requests']
+
+            def create_server():
+                # The queue must outlive a worker process that is replaced, and the chunks of an upload would be
+                # split between the worker processes
+                return RPCServer(
+                    consumers = consumers, conn_parameters=conn_parameters,
+                    queue_name=options['queue'], auto_delete=not prefork,
+                    accept_uploads=options['processes'] <= 1)
+        except Exception:
+            traceback.print_exc()
+            sys.exit(1)
+
+        if prefork:
+            # Consumers are imported already, the children share those pages
+            Prefork(create_server, options['processes'], options['max_requests']).run()
+            return
+        server = create_server()
+        try:
             server.run()
         except KeyboardInterrupt:
             server.stop()
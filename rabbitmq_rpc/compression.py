@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+'''
+Payload compression. Bodies larger than a threshold are compressed, and the codec name is sent in the AMQP
+content_encoding property. Received bodies are decompressed according to their content_encoding, whatever the
+local threshold is, so only the sender has to enable compression.
+'''
+import threading
+import time
+import zlib
+
+_codecs = {}
+
+
+def register(encoding, compress, decompress):
+    """Register a compression codec.
+
+    :param str encoding: The content_encoding value, e.g. 'zlib'
+    :param callable compress: (bytes, level) -> bytes
+    :param callable decompress: bytes -> bytes
+
+    """
+    _codecs[encoding] = (compress, decompress)
+
+
+register('zlib', zlib.compress, zlib.decompress)
+
+
+class Compressor(object):
+    '''
+    Compress bodies above a size threshold and keep counters of the work done.
+    Parameters:
+        threshold: Bodies smaller than threshold bytes are sent as is. None disables compression.
+        level: Compression level passed to the codec.
+        encoding: Codec name, 'zlib' is builtin.
+    '''
+    def __init__(self, threshold=None, level=6, encoding='zlib'):
+        if encoding not in _codecs:
+            raise ValueError("Unknown compression '%s'." % encoding)
+        self.threshold = threshold
+        self.level = level
+        self.encoding = encoding
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+        self.decompressed = 0
+        self.decompress_time = 0.0
+
+    def compress(self, body):
+        """Compress body if it is large enough.
+
+        :rtype: tuple(bytes, str or None): The body to send and its content_encoding
+
+        """
+        if self.threshold is None or len(body) < self.threshold:
+            return body, None
+        start = time.thread_time()
+        data = _codecs[self.encoding][0](body, self.level)
+        elapsed = time.thread_time() - start
+        with self._lock:
+            self.compress_time += elapsed
+            if len(data) >= len(body):
+                return body, None
+            self.compressed += 1
+            self.bytes_in += len(body)
+            self.bytes_out += len(data)
+        return data, self.encoding
+
+    def decompress(self, body, content_encoding):
+        """Decompress a received body. Bodies with no content_encoding, or one
+        that isn't a registered codec, are returned as is.
+
+        """
+        if not content_encoding or content_encoding not in _codecs:
+            return body
+        start = time.thread_time()
+        data = _codecs[content_encoding][1](body)
+        elapsed = time.thread_time() - start
+        with self._lock:
+            self.decompressed += 1
+            self.decompress_time += elapsed
+        return data
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def stats(self):
+        with self._lock:
+            return {
+                'compressed': self.compressed,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'bytes_saved': self.bytes_in - self.bytes_out,
+                'compress_time': self.compress_time,
+                'decompressed': self.decompressed,
+                'decompress_time': self.decompress_time,
+            }
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+'''
+Pipelined publisher confirms. Messages are published without waiting for their confirm: the tracker maps delivery
+tags to the caller's future, resolves them as Basic.Ack/Basic.Nack frames (with or without multiple) arrive, and
+bounds the number of unconfirmed messages.
+'''
+import collections
+import threading
+import time
+
+from .exceptions import PublishNacked, RemoteCallTimeout
+
+
+class _Pending(object):
+
+    def __init__(self, future, count):
+        self.future = future
+        self.remaining = count
+        self.nacked = False
+
+
+class ConfirmTracker(object):
+    '''
+    Track the confirms of a channel in confirm mode.
+    Parameters:
+        max_in_flight: Max number of messages published and not confirmed yet. acquire() blocks past it.
+    '''
+    def __init__(self, max_in_flight=1000):
+        self.max_in_flight = max_in_flight
+        self._cond = threading.Condition()
+        # delivery tag -> _Pending, in publish order
+        self._tags = collections.OrderedDict()
+        self._next_tag = 1
+        # Slots taken by acquire() and not released by a confirm yet
+        self._in_flight = 0
+        self._nacked_since_wait = 0
+        self.published = 0
+        self.acked = 0
+        self.nacked = 0
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self, count=1, timeout=None):
+        """Take count slots of the in-flight window, blocking while it's full.
+        Called by the publishing thread before the messages are handed to the
+        I/O thread.
+
+        :raises RemoteCallTimeout: No slot was freed within timeout seconds
+
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            # A message larger than the window still goes out once the window is empty
+            while self._in_flight and self._in_flight + count > self.max_in_flight:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise RemoteCallTimeout('Waiting for publisher confirms timeout.')
+                self._cond.wait(remaining)
+            self._in_flight += count
+
+    def register(self, future, count=1):
+        """Record the delivery tags of count messages just published on the
+        channel. Must be called on the I/O thread right after basic_publish.
+
+        :param concurrent.futures.Future future: Resolved with True when every
+            message is acked, failed with PublishNacked if any of them is nacked
+        :param int count: Number of messages published
+
+        """
+        pending = _Pending(future, count)
+        with self._cond:
+            for _ in range(count):
+                self._tags[self._next_tag] = pending
+                self._next_tag += 1
+            self.published += count
+
+    def on_delivery_confirmation(self, method_frame):
+        """Invoked by pika with the Basic.Ack or Basic.Nack of the broker."""
+        method = method_frame.method
+        acked = method.NAME == 'Basic.Ack'
+        done = []
+        with self._cond:
+            if method.multiple:
+                tags = []
+                for tag in self._tags:
+                    if tag > method.delivery_tag:
+                        break
+                    tags.append(tag)
+            else:
+                tags = [method.delivery_tag] if method.delivery_tag in self._tags else []
+            for tag in tags:
+                pending = self._tags.pop(tag)
+                pending.remaining -= 1
+                if not acked:
+                    pending.nacked = True
+                if pending.remaining == 0:
+                    done.append(pending)
+            if acked:
+                self.acked += len(tags)
+            else:
+                self.nacked += len(tags)
+                self._nacked_since_wait += len(tags)
+            self._in_flight -= len(tags)
+            self._cond.notify_all()
+        for pending in done:
+            self._resolve(pending)
+
+    def _resolve(self, pending):
+        if pending.future is None or pending.future.done():
+            return
+        if pending.nacked:
+            pending.future.set_exception(PublishNacked('The message was rejected by the broker.'))
+        else:
+            pending.future.set_result(True)
+
+    def fail(self, error):
+        """Fail every unconfirmed message, e.g. when the connection is lost."""
+        with self._cond:
+            pendings = set(self._tags.values())
+            self._tags.clear()
+            self._in_flight = 0
+            self._cond.notify_all()
+        for pending in pendings:
+            if pending.future is not None and not pending.future.done():
+                pending.future.set_exception(error)
+
+    def release(self, count=1):
+        """Give back slots of messages that were not published after all."""
+        with self._cond:
+            self._in_flight -= count
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until every message published so far is confirmed.
+
+        :return: False if some message was nacked since the last wait, else True
+        :raises RemoteCallTimeout: Not confirmed within timeout seconds
+
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while self._in_flight:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise RemoteCallTimeout('Waiting for publisher confirms timeout.')
+                self._cond.wait(remaining)
+            nacked, self._nacked_since_wait = self._nacked_since_wait, 0
+        return nacked == 0
+
+    def stats(self):
+        with self._cond:
+            return {
+                'published': self.published,
+                'acked': self.acked,
+                'nacked': self.nacked,
+                'in_flight': self._in_flight,
+            }
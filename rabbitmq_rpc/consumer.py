@@ -1,27 +1,103 @@
 # -*- coding: utf-8 -*-
+import inspect
 import logging
-import pickle
-import json
+import multiprocessing
+import os
+import time
+from functools import partial
+from threading import Condition, Lock, Thread
 
 import pika
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from six import python_2_unicode_compatible
 
-from .threadtool import ThreadAtomLock
+from .base import Connector
+from . import serializers
+from .compression import Compressor
+from .upload import UploadReassembler
+from .outbox import ReplyOutbox
+from .metrics import ConsumerMetrics
+from .aioloop import EventLoopThread
+from .threadtool import PriorityExecutor
+from .cache import ResultCache, canonical_key, request_key
 
-from .exceptions import ERROR_FLAG, HAS_ERROR, NO_ERROR
-from functools import partial
+from .exceptions import (ERROR_FLAG, HAS_ERROR, NO_ERROR, BATCH_FLAG, STREAM_FLAG, STREAM_SEQ, STREAM_END, MAX_AGE,
+                         DEADLINE, SENT_AT, RECV_AT, HANDLER_START, HANDLER_END, REPLY_AT, UPLOAD_ID,
+                         UploadError)
 logger = logging.getLogger(__name__)
 
+EXECUTORS = ('inline', 'thread', 'process')
+# Error replied to a batch request whose body isn't {'batch': [call, ...]}
+MALFORMED_BATCH = 'Malformed batch request: expected {"batch": [call, ...]}.'
+# Requests of a cached consumer up to this size are hashed on the ioloop, to reply the cache hits from there
+RAW_KEY_MAX_SIZE = 4096
+
+# Consumers run by a process pool, by id. The workers of the pool are forked after their consumer is added here.
+_process_consumers = {}
+
 
 @python_2_unicode_compatible
 class Consumer(object):
-
-    def __init__(self, name, queue=None, exclusive=False):
+    '''
+    A remote function. In threaded mode, a coroutine function (async def) runs on the asyncio event loop of the server
+    and holds no thread while it waits, see aioloop.py.
+    Parameters:
+        name: name the clients call it with.
+        queue: queue it's consumed from. Default: the default queue of the server.
+        exclusive: no other consumer may share its queue.
+        serializer: name of the serializer for requests without content_type, see serializers.py. Requests with a
+            content_type are always decoded with the matching serializer and replied in the same format.
+        compress_threshold: Replies larger than compress_threshold bytes are compressed with zlib. Default None,
+            no compression.
+        compress_level: zlib compression level.
+        batch_size: If set, the function is a batching consumer. It's called with a list of (args, kwargs) of up to
+            batch_size requests and must return the list of their results in the same order. Every request is still
+            replied and acked on its own. Needs the threaded server.
+        batch_timeout_ms: A batch is run when batch_size requests are pending, or batch_timeout_ms after its first
+            request arrived.
+        cache: Cache the results by arguments: True, or a dict of cache.ResultCache parameters (maxsize, maxbytes,
+            ttl). A cached call is replied at once without running the function. A request of up to RAW_KEY_MAX_SIZE
+            bytes whose body is the same as one already answered from the cache is replied on the ioloop with the
+            reply encoded the first time, without waiting for a thread. Other hits are decoded and replied on a
+            thread. Errors and generators are not cached.
+        coalesce: Identical calls, by canonical arguments, arriving while one of them is running wait for it instead of
+            running again. Each of them is still replied and acked on its own. Generators are collected into a list
+            first, and stream calls are never coalesced.
+        max_age: Seconds clients may cache the results for, sent in the max_age_ms reply header. 0 forbids caching.
+            Default None, no header: the client's own cache settings apply.
+        executor: Where the function runs in threaded mode. Default None, 'thread'.
+            'inline': on the ioloop thread, right when the request is delivered. For short functions only, as the
+                ioloop is blocked meanwhile.
+            'thread': on a thread pool, the pool of the server, or one of its own with max_workers threads.
+            'process': on a pool of max_workers forked processes, for CPU-bound functions. The request body is handed
+                to the pool as received and decoded in the worker process. Arguments and results must be picklable,
+                generators are collected into a list, and batch_size, cache and coalesce are not supported.
+        max_workers: Size of the pool of the 'thread' and 'process' executors. Default None: the server's pool for
+            'thread', the number of CPUs for 'process'.
+    '''
+    def __init__(self, name, queue=None, exclusive=False, serializer=None, compress_threshold=None,
+                 compress_level=6, batch_size=None, batch_timeout_ms=10, cache=None, coalesce=False, max_age=None,
+                 executor=None, max_workers=None):
+        if executor is not None and executor not in EXECUTORS:
+            raise ValueError("Unknown executor '%s', expected one of %s." % (executor, ', '.join(EXECUTORS)))
+        if executor == 'process' and (batch_size or cache or coalesce):
+            raise ValueError("executor='process' can't be combined with batch_size, cache or coalesce.")
         self.name = name
         self.queue = queue
         self.exclusive = exclusive
         self.bJsonParameters = False
+        # Used for requests without a known content_type
+        self.serializer = serializer
+        # Replies larger than compress_threshold are compressed
+        self.compressor = Compressor(compress_threshold, compress_level)
+        self.batch_size = batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+        self.cache = ResultCache.create(cache)
+        self.coalesce = coalesce
+        self.max_age = max_age
+        self.executor = executor or 'thread'
+        self.max_workers = max_workers
+        self.metrics = ConsumerMetrics()
 
     def consume(self, *args, **kwargs):
         pass
@@ -33,35 +109,273 @@ class Consumer(object):
         return '<%s.Consumer: %s>' % (self.__module__, self.name)
 
 
-def consumer(name=None, queue=None, exclusive=False):
+def consumer(name=None, queue=None, exclusive=False, **options):
+    """Decorate func as a Consumer. options: See Consumer."""
 
     def decorator(func):
         cname = name or func.__name__
 
-        c = Consumer(cname, queue, exclusive)
+        c = Consumer(cname, queue, exclusive, **options)
         c.consume = func
         return c
 
     return decorator
 
-ReplyLockName = "_MsgReply"
+def parse_arguments(arguments, body=None):
+    """Turn decoded request arguments into (args, kwargs)."""
+    if not isinstance(arguments, dict):
+        if isinstance(arguments, list) or isinstance(arguments, tuple):
+            args = arguments
+            kwargs = {}
+        else:
+            args = []
+            kwargs = {"ErrorInfo":f"Invalid parameters, original arguments: {arguments}, original body: {body}"}
+    else:
+        args = arguments.get('args', [])
+        kwargs = arguments.get('kwargs', {})
+        if not (isinstance(args, list) or isinstance(args, tuple)):
+            args = [args]
+        if not isinstance(kwargs, dict):
+            kwargs = {'kwargs':kwargs}
+        if len(args) == 0 and len(kwargs) == 0 and len(arguments):
+            kwargs = arguments
+    return args, kwargs
+
+
+def batch_calls(arguments):
+    """The calls of a decoded batch request, None if it's malformed."""
+    calls = arguments.get('batch') if isinstance(arguments, dict) else None
+    if not isinstance(calls, (list, tuple)):
+        return None
+    return calls
+
+
+def expired(props):
+    """Whether the deadline of a request has passed."""
+    deadline = (props.headers or {}).get(DEADLINE)
+    return deadline is not None and time.time() * 1000 > deadline
+
+
+def create_process_pool(consumer):
+    """Create the process pool of an executor='process' consumer and fork its
+    workers at once. Call it before the connection is opened: the workers
+    must not inherit its socket, nor the I/O threads of the server.
+
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise ValueError("executor='process' needs the fork start method, which this platform doesn't provide.")
+    # The workers find the consumer by id in their copy of this dict
+    _process_consumers[id(consumer)] = consumer
+    executor = ProcessPoolExecutor(consumer.max_workers, mp_context=multiprocessing.get_context('fork'))
+    # The first task forks the workers, now, before any request is in progress
+    executor.submit(int)
+    return executor
+
+
+def _run_in_process(consumer_id, serializer_name, content_encoding, body, batch, deadline=None):
+    """Decode a request and call its consumer. Runs in a worker process of a
+    'process' executor.
+
+    :rtype: tuple(result or error message, is_error, is_generator, decode seconds, handler seconds, expired)
+
+    """
+    consumer = _process_consumers[consumer_id]
+    if deadline is not None and time.time() * 1000 > deadline:
+        return None, False, False, 0.0, 0.0, True
+    start = time.perf_counter()
+    try:
+        body = consumer.compressor.decompress(body, content_encoding)
+        arguments = serializers.get_serializer(serializer_name).loads(body)
+    except Exception as e:
+        logger.error("Load arguments failed: {}".format(e))
+        arguments = {}
+    decode = time.perf_counter() - start
+
+    def run(args, kwargs):
+        try:
+            ret = consumer.consume(*args, **kwargs)
+            # Generators can't be sent back to the server process
+            if inspect.isgenerator(ret):
+                return list(ret), False, True
+            return ret, False, False
+        except Exception as ex:
+            logger.exception(
+                'Error occurred when calling consumer. consumer: %s, args: %s, '
+                'kwargs: %s', consumer.name, args, kwargs)
+            return str(ex), True, False
+
+    start = time.perf_counter()
+    if batch:
+        calls = batch_calls(arguments)
+        if calls is None:
+            return MALFORMED_BATCH, True, False, decode, 0.0, False
+        results = []
+        for call in calls:
+            ret, is_error, _ = run(*parse_arguments(call))
+            results.append([is_error, ret])
+        return results, False, False, decode, time.perf_counter() - start, False
+    ret, is_error, is_generator = run(*parse_arguments(arguments, body))
+    return ret, is_error, is_generator, decode, time.perf_counter() - start, False
+
+
+class BatchCall(object):
+    '''
+    One batch request: every call of the batch runs as its own task, and the last one to finish
+    replies with the list of [is_error, result] in input order and acks the message.
+    '''
+    def __init__(self, dispatcher, consumer, delivery_tag, props, size):
+        self.dispatcher = dispatcher
+        self.consumer = consumer
+        self.delivery_tag = delivery_tag
+        self.props = props
+        self.results = [None] * size
+        self._remaining = size
+        self._lock = Lock()
+
+    def run(self, index, args, kwargs):
+        ret, is_error = self.dispatcher.run_consumer(self.consumer, args, kwargs)
+        self.results[index] = [is_error, ret]
+        with self._lock:
+            self._remaining -= 1
+            done = self._remaining == 0
+        if done:
+            self.dispatcher.stamp(self.props, HANDLER_END)
+            self.dispatcher.finish_call(self.consumer, self.delivery_tag, self.props, self.results, False)
+
+
+class MicroBatcher(object):
+    '''
+    Gathers the requests of a batching consumer. A batch is handed to the dispatcher when batch_size requests are
+    pending, or by a timer thread batch_timeout_ms after the first request of the batch arrived.
+    '''
+    def __init__(self, dispatcher, consumer):
+        self.dispatcher = dispatcher
+        self.consumer = consumer
+        self._timeout = consumer.batch_timeout_ms / 1000.0
+        self._pending = []
+        self._deadline = None
+        self._cond = Condition(Lock())
+        self._thread = None
+        self._stopped = False
+
+    def add(self, delivery_tag, props, args, kwargs):
+        with self._cond:
+            self._pending.append((delivery_tag, props, args, kwargs))
+            if len(self._pending) >= self.consumer.batch_size:
+                batch = self._take()
+            else:
+                batch = None
+                if len(self._pending) == 1:
+                    self._deadline = time.time() + self._timeout
+                    if self._thread is None:
+                        self._thread = Thread(target=self._run, name='rabbitmq_rpc-batch-%s' % self.consumer.name)
+                        self._thread.daemon = True
+                        self._thread.start()
+                    self._cond.notify()
+        if batch:
+            self.dispatcher.submit_batch(self.consumer, batch)
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        self._deadline = None
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    remaining = self._deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+                batch = self._take()
+            self.dispatcher.submit_batch(self.consumer, batch)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+
 class MessageDispatcher(object):
-    def __init__(self, connection, channel, exchange='', threaded = True, threadpool_size = -1):
+    def __init__(self, connection, channel, exchange='', threaded = True, threadpool_size = -1, uploads = None,
+                 outbox = None, aioloop = None, process_pools = None):
         self._connection = connection
         self._channel = channel
         self._registries = {}
         if threadpool_size <= 0:
-            self._executor = ThreadPoolExecutor()
-        else:
-            self._executor = ThreadPoolExecutor(threadpool_size)
+            # The default of ThreadPoolExecutor
+            threadpool_size = min(32, (os.cpu_count() or 1) + 4)
+        self.threadpool_size = threadpool_size
+        # Requests waiting for a thread run by AMQP priority
+        self._executor = PriorityExecutor(threadpool_size)
         self._exchange = exchange
         self._threaded = threaded
+        # Executors of the consumers with their own pool, by consumer name
+        self._executors = {}
+        self._batchers = {}
+        # Coalesced calls in flight: (consumer name, arguments key) -> [(delivery_tag, props), ...]
+        self._inflight = {}
+        self._inflight_lock = Lock()
+        # Reassembles chunked requests, may be shared by the dispatchers of a server
+        self._uploads = uploads if uploads is not None else UploadReassembler()
+        # Replies and acks are handed to the ioloop through the outbox of the channel
+        self._outbox = outbox if outbox is not None else ReplyOutbox(connection, channel, threaded)
+        # Runs the coroutine consumers, may be shared by the dispatchers of a server
+        self._aioloop = aioloop if aioloop is not None else EventLoopThread()
+        # Pools of the executor='process' consumers forked before the connection was opened, by consumer name
+        self._process_pools = process_pools or {}
 
         self.consumer_tag = None
 
     def register(self, consumer):
         if consumer.name not in self._registries:
             self._registries[consumer.name] = consumer
+            if consumer.batch_size and self._threaded:
+                self._batchers[consumer.name] = MicroBatcher(self, consumer)
+            executor = self.create_executor(consumer)
+            if executor is not None:
+                self._executors[consumer.name] = executor
+
+    def create_executor(self, consumer):
+        """Create the pool of a consumer, if it doesn't use the pool of the
+        dispatcher.
+
+        """
+        if consumer.executor == 'process':
+            if consumer.name in self._process_pools:
+                return self._process_pools[consumer.name]
+            return create_process_pool(consumer)
+        if consumer.executor == 'thread' and consumer.max_workers and self._threaded:
+            return PriorityExecutor(consumer.max_workers, thread_name_prefix='rabbitmq_rpc-%s' % consumer.name)
+        return None
+
+    @property
+    def consumers(self):
+        return list(self._registries.values())
+
+    @property
+    def workers(self):
+        """Number of threads and processes running the consumers."""
+        workers = self.threadpool_size
+        for consumer in self._registries.values():
+            if consumer.name in self._executors:
+                workers += consumer.max_workers or os.cpu_count() or 1
+        return workers
+
+    def executor_for(self, consumer):
+        """The thread pool the calls of consumer run on, None to run them in
+        the calling thread.
+
+        """
+        if not self._threaded or consumer.executor == 'inline':
+            return None
+        return self._executors.get(consumer.name, self._executor)
 
     def __call__(self, *args, **kwargs):
         return self.dispatch_message(*args, **kwargs)
@@ -82,6 +396,69 @@ class MessageDispatcher(object):
         :param pika.Spec.BasicProperties: properties
         :param Bytes or json: The message body
 
+        """
+        delivery_tag = basic_deliver.delivery_tag
+        self.stamp(properties, RECV_AT)
+        self._outbox.delivered(delivery_tag)
+        if not self._threaded:
+            self.handle_message(delivery_tag, properties, body)
+            return
+        # Only the raw delivery is handed over, so decoding never blocks the ioloop. Chunks of uploads and unknown
+        # functions are handled on the pool of the dispatcher.
+        consumer = None
+        if UPLOAD_ID not in (properties.headers or {}):
+            consumer = self.lookup_consumer(properties)[1]
+        if consumer is None:
+            self._executor.submit_priority(properties.priority, self.handle_message, delivery_tag, properties, body)
+        elif consumer.executor == 'process':
+            self.submit_process(consumer, delivery_tag, properties, body)
+        else:
+            executor = self.executor_for(consumer)
+            if executor is None:
+                self.handle_message(delivery_tag, properties, body, consumer)
+                return
+            raw_key = None
+            if self.raw_keyed(consumer, properties, body):
+                raw_key = request_key(properties.content_type, properties.content_encoding, body)
+                if self.reply_cached(consumer, delivery_tag, properties, raw_key):
+                    return
+            executor.submit_priority(properties.priority, self.handle_message, delivery_tag, properties, body,
+                                     consumer, raw_key)
+
+    def raw_keyed(self, consumer, props, body):
+        """Whether a request may be replied from the cache by the hash of its
+        raw body: small enough to be hashed on the ioloop, and replied with a
+        single message.
+
+        """
+        if consumer.cache is None or consumer.batch_size or len(body) > RAW_KEY_MAX_SIZE:
+            return False
+        headers = props.headers or {}
+        return not headers.get(BATCH_FLAG) and not headers.get(STREAM_FLAG)
+
+    def reply_cached(self, consumer, delivery_tag, props, raw_key):
+        """Reply the cached result of a request found by the hash of its raw
+        body, with the reply encoded when it was cached. Runs on the ioloop, so
+        cache hits don't wait for a thread, and cost only a publish.
+
+        :rtype: bool: Whether the request was handled
+
+        """
+        found, reply = consumer.cache.get_alias(raw_key)
+        if not found:
+            return False
+        self.received(consumer, props)
+        if expired(props):
+            self.drop_expired(consumer, delivery_tag)
+        else:
+            self.finish_encoded_call(consumer, delivery_tag, props, *reply)
+        return True
+
+    def lookup_consumer(self, properties):
+        """The consumer a request calls, the default one for unknown names.
+
+        :rtype: tuple(requested name, Consumer or None)
+
         """
         try:
             consumer_name = properties.headers.get('consumer_name')
@@ -89,89 +466,545 @@ class MessageDispatcher(object):
             consumer_name = 'default'
         if consumer_name is None:
             consumer_name = 'default'
+        consumer = self._registries.get(consumer_name)
+        if consumer is None:
+            consumer = self._registries.get('default')
+        return consumer_name, consumer
 
-        logger.info("Received a remote call on function '%s'", consumer_name)
-        old_consumer_name = consumer_name
-        if consumer_name not in self._registries:
-            consumer_name = "default"
-        try:
-            consumer = self._registries[consumer_name]
-        except KeyError:
-            msg = "Function '%s' not found." % old_consumer_name
-            logger.info(msg)
-            if properties.reply_to:
-                self.reply_message(
-                    properties, msg, is_error=True)
-            self.acknowledge_message(basic_deliver.delivery_tag)
-            return
+    def handle_message(self, delivery_tag, properties, body, consumer=None, raw_key=None):
+        """Look the consumer up, decode the request and call the consumer. Runs
+        on a worker thread in threaded mode, unless the consumer is 'inline'.
+        raw_key is the request_key of the body, for the result cache.
 
+        """
+        if UPLOAD_ID in (properties.headers or {}):
+            body = self.add_upload_chunk(delivery_tag, properties, body)
+            if body is None:
+                return
+        if consumer is None:
+            consumer_name, consumer = self.lookup_consumer(properties)
+            if consumer is None:
+                msg = "Function '%s' not found." % consumer_name
+                logger.info(msg)
+                if properties.reply_to:
+                    self.reply_message(
+                        properties, msg, is_error=True,
+                        serializer=serializers.find_serializer(properties.content_type))
+                self.acknowledge_message(delivery_tag)
+                return
+            if consumer.executor == 'process':
+                self.submit_process(consumer, delivery_tag, properties, body)
+                return
+
+        self.received(consumer, properties)
+        if expired(properties):
+            self.drop_expired(consumer, delivery_tag)
+            return
+        start = time.perf_counter()
         try:
-            if not consumer.bJsonParameters:
-                arguments = pickle.loads(body)
-            else:
-                arguments = json.loads(body.decode('utf-8'))
+            body = consumer.compressor.decompress(body, properties.content_encoding)
+            arguments = self.find_serializer(consumer, properties).loads(body)
         except Exception as e:
             logger.error("Load arguments failed: {}".format(e))
             arguments = {}
-        if not isinstance(arguments, dict):
-            if isinstance(arguments, list) or isinstance(arguments, tuple):
-                args = arguments
-                kwargs = {}
+        consumer.metrics.decode.observe(time.perf_counter() - start)
+        if expired(properties):
+            self.drop_expired(consumer, delivery_tag)
+            return
+        if (properties.headers or {}).get(BATCH_FLAG):
+            calls = batch_calls(arguments)
+            if calls is None:
+                logger.error("Malformed batch request of function '%s'.", consumer.name)
+                self.finish_call(consumer, delivery_tag, properties, MALFORMED_BATCH, True)
             else:
-                args = []
-                kwargs = {"ErrorInfo":f"Invalid parameters, original arguments: {arguments}, original body: {body}"}
+                self.call_batch(consumer, delivery_tag, properties, calls)
+            return
+        args, kwargs = parse_arguments(arguments, body)
+        if (consumer.cache is not None or consumer.coalesce) and not consumer.batch_size:
+            self.call_keyed_consumer(consumer, delivery_tag, properties, args, kwargs, raw_key)
+        elif consumer.batch_size:
+            if consumer.name in self._batchers:
+                self._batchers[consumer.name].add(delivery_tag, properties, args, kwargs)
+            else:
+                self.call_batch_consumer(consumer, [(delivery_tag, properties, args, kwargs)])
+        elif self._threaded and inspect.iscoroutinefunction(consumer.consume):
+            self.call_coroutine(consumer, delivery_tag, properties, args, kwargs)
         else:
-            args = arguments.get('args', [])
-            kwargs = arguments.get('kwargs', {})
-            if not (isinstance(args, list) or isinstance(args, tuple)):
-                args = [args]
-            if not isinstance(kwargs, dict):
-                kwargs = {'kwargs':kwargs}
-            if len(args) == 0 and len(kwargs) == 0 and len(arguments):
-                kwargs = arguments
+            self.call_comsumer(consumer, delivery_tag, properties, *args, **kwargs)
+
+    def submit_process(self, consumer, delivery_tag, props, body):
+        """Hand a request over to the process pool of its consumer. The body is
+        passed as received and decoded in the worker process, then the result
+        is replied and acked by finish_process_call.
+
+        """
+        self.received(consumer, props)
+        if expired(props):
+            self.drop_expired(consumer, delivery_tag)
+            return
+        headers = props.headers or {}
+        serializer = self.find_serializer(consumer, props)
+        future = self._executors[consumer.name].submit(
+            _run_in_process, id(consumer), serializer.name, props.content_encoding, bytes(body),
+            bool(headers.get(BATCH_FLAG)), headers.get(DEADLINE))
+        callback = partial(self.finish_process_call, consumer, delivery_tag, props)
         if not self._threaded:
-            self.call_comsumer(consumer, basic_deliver.delivery_tag, properties, *args, **kwargs)
+            # The blocking connection must only be used by its own thread
+            callback(future)
         else:
-            self._executor.submit(self.call_comsumer, consumer,
-                                basic_deliver.delivery_tag, properties, *args, **kwargs)
-    @ThreadAtomLock(ReplyLockName)
-    def reply_message(self, props, body, headers=None, is_error=False):
+            future.add_done_callback(callback)
+
+    def finish_process_call(self, consumer, delivery_tag, props, future):
+        try:
+            ret, is_error, is_generator, decode, handler, is_expired = future.result()
+        except Exception as ex:
+            # The worker died, or the result can't be pickled
+            logger.error("Calling consumer %s in a worker process failed: %r", consumer.name, ex)
+            ret, is_error, is_generator = str(ex), True, False
+        else:
+            if is_expired:
+                self.drop_expired(consumer, delivery_tag)
+                return
+            consumer.metrics.decode.observe(decode)
+            consumer.metrics.handler.observe(handler)
+            now = time.time()
+            self.stamp(props, HANDLER_START, now - handler)
+            self.stamp(props, HANDLER_END, now)
+        if is_generator:
+            # Streamed back chunk by chunk if the caller asked for a stream
+            ret = (chunk for chunk in ret)
+        self.finish_call(consumer, delivery_tag, props, ret, is_error)
+
+    def stamp(self, props, header, at=None):
+        """Record when a request reached a step, in a timing header (see
+        exceptions.RECV_AT) returned with its reply. Only requests stamped by
+        the client with SENT_AT are.
+
+        """
+        headers = props.headers
+        if headers is not None and SENT_AT in headers:
+            headers[header] = int((at if at is not None else time.time()) * 1000000)
+
+    def timing_headers(self, props):
+        """The timing headers of the reply to a request."""
+        headers = props.headers or {}
+        if SENT_AT not in headers:
+            return {}
+        return dict((header, headers[header]) for header in (SENT_AT, RECV_AT, HANDLER_START, HANDLER_END)
+                    if header in headers)
+
+    def received(self, consumer, props):
+        """Count a request of consumer, and the time it waited since it was
+        published.
+
+        """
+        logger.debug("Received a remote call on function '%s'", consumer.name)
+        metrics = consumer.metrics
+        metrics.received.inc()
+        sent_at = (props.headers or {}).get(SENT_AT)
+        if sent_at is not None:
+            metrics.queue_wait.observe(max(time.time() - sent_at / 1000000.0, 0.0))
+
+    def drop_expired(self, consumer, delivery_tag):
+        """Ack a request whose caller no longer waits, without running it."""
+        logger.info("Dropped an expired call of function '%s'.", consumer.name)
+        consumer.metrics.expired.inc()
+        self.acknowledge_message(delivery_tag)
+
+    def add_upload_chunk(self, delivery_tag, props, chunk):
+        """Add a chunk of an uploaded request. Every chunk but the last one is
+        acked at once, the last one is acked as the request.
+
+        :return: The reassembled request body after its last chunk, otherwise None
+
+        """
+        try:
+            body = self._uploads.add(props.headers, chunk)
+        except UploadError as ex:
+            logger.error("Upload %s rejected: %s", props.headers.get(UPLOAD_ID), ex)
+            if props.reply_to:
+                self.reply_message(props, str(ex), is_error=True,
+                                   serializer=serializers.find_serializer(props.content_type))
+            body = None
+        if body is None:
+            self.acknowledge_message(delivery_tag)
+        return body
+
+    def call_keyed_consumer(self, consumer, delivery_tag, props, args, kwargs, raw_key=None):
+        """Call a consumer whose calls are keyed by their arguments: reply a
+        cached result at once, wait for an identical call in flight, or call
+        the consumer. The result is also cached under raw_key, so the next
+        request with the same body is replied on the ioloop.
+
+        """
+        try:
+            key = canonical_key(args, kwargs)
+        except Exception:
+            logger.debug("Arguments of '%s' can't be hashed.", consumer.name)
+            key = None
+        if key is not None and consumer.cache is not None:
+            found, ret = consumer.cache.get(key)
+            if found:
+                self.finish_cached_call(consumer, delivery_tag, props, key, raw_key, ret)
+                return
+        if key is not None and consumer.coalesce and not (props.headers or {}).get(STREAM_FLAG):
+            with self._inflight_lock:
+                waiters = self._inflight.get((consumer.name, key))
+                if waiters is not None:
+                    waiters.append((delivery_tag, props))
+                    return
+                self._inflight[(consumer.name, key)] = [(delivery_tag, props)]
+            self.call_comsumer_coalesced(consumer, key, args, kwargs)
+        else:
+            self.call_comsumer_caching(consumer, key, delivery_tag, props, args, kwargs, raw_key)
+
+    def call_comsumer_caching(self, consumer, key, delivery_tag, props, args, kwargs, raw_key=None):
+        ret, is_error = self.run_consumer(consumer, args, kwargs, props)
+        if key is not None and consumer.cache is not None and not is_error and not inspect.isgenerator(ret):
+            consumer.cache.put(key, ret)
+            self.finish_cached_call(consumer, delivery_tag, props, key, raw_key, ret)
+        else:
+            self.finish_call(consumer, delivery_tag, props, ret, is_error)
+
+    def finish_cached_call(self, consumer, delivery_tag, props, key, raw_key, ret):
+        """Reply a result found in or just put in the cache. The reply is
+        encoded once and cached with raw_key, so the next request with the
+        same body is replied on the ioloop, see reply_cached.
+
+        """
+        if raw_key is None or props.reply_to is None:
+            self.finish_call(consumer, delivery_tag, props, ret, False)
+            return
+        serializer = self.find_serializer(consumer, props)
+        try:
+            body, content_encoding = self.encode_reply(ret, serializer, consumer.compressor)
+        except Exception:
+            # Replied as an encoding error
+            self.finish_call(consumer, delivery_tag, props, ret, False)
+            return
+        consumer.cache.alias(raw_key, key, (body, content_encoding), len(body))
+        self.finish_encoded_call(consumer, delivery_tag, props, body, content_encoding)
+
+    def finish_encoded_call(self, consumer, delivery_tag, props, body, content_encoding):
+        """Reply a successful result already encoded, then ack the request."""
+        is_error = False
+        try:
+            if props.reply_to is not None:
+                start = time.perf_counter()
+                headers = self.timing_headers(props)
+                if consumer.max_age is not None:
+                    headers[MAX_AGE] = int(consumer.max_age * 1000)
+                self.publish_reply(props, body, self.find_serializer(consumer, props).content_type, content_encoding,
+                                   headers)
+                consumer.metrics.reply.observe(time.perf_counter() - start)
+        except Exception:
+            logger.exception('Replying a call of consumer %s failed.', consumer.name)
+            is_error = True
+        finally:
+            (consumer.metrics.failed if is_error else consumer.metrics.succeeded).inc()
+            self.acknowledge_message(delivery_tag)
+
+    def call_comsumer_coalesced(self, consumer, key, args, kwargs):
+        """Run a coalesced call, then reply and ack every request that waited
+        for it.
+
+        """
+        started = time.time()
+        ret, is_error = self.run_consumer(consumer, args, kwargs)
+        if not is_error and inspect.isgenerator(ret):
+            ret, is_error = self.collect_generator(consumer, ret)
+        ended = time.time()
+        if consumer.cache is not None and not is_error:
+            # Cached before the waiters are released, so later calls hit the cache
+            consumer.cache.put(key, ret)
+        with self._inflight_lock:
+            waiters = self._inflight.pop((consumer.name, key))
+        for delivery_tag, props in waiters:
+            self.stamp(props, HANDLER_START, started)
+            self.stamp(props, HANDLER_END, ended)
+            self.finish_call(consumer, delivery_tag, props, ret, is_error)
+
+    def call_batch(self, consumer, delivery_tag, props, calls):
+        """Run every call of a batch request, in parallel on the thread pool in
+        threaded mode. One reply is sent for the whole batch.
+
+        """
+        self.stamp(props, HANDLER_START)
+        if not calls:
+            self.stamp(props, HANDLER_END)
+            self.finish_call(consumer, delivery_tag, props, [], False)
+            return
+        if consumer.batch_size:
+            # A batching consumer takes the whole batch request in one call
+            calls = [parse_arguments(arguments) for arguments in calls]
+            self.call_batch_request(consumer, delivery_tag, props, calls)
+            return
+        batch = BatchCall(self, consumer, delivery_tag, props, len(calls))
+        executor = self.executor_for(consumer)
+        for index, arguments in enumerate(calls):
+            args, kwargs = parse_arguments(arguments)
+            if executor is None:
+                batch.run(index, args, kwargs)
+            else:
+                executor.submit_priority(props.priority, batch.run, index, args, kwargs)
+
+    def submit_batch(self, consumer, batch):
+        executor = self.executor_for(consumer)
+        if executor is None:
+            self.call_batch_consumer(consumer, batch)
+        else:
+            executor.submit(self.call_batch_consumer, consumer, batch)
+
+    def run_batch_consumer(self, consumer, calls):
+        """Call a batching consumer with a list of (args, kwargs).
+
+        :rtype: list of (result or error message, is_error), one per call
+
+        """
+        start = time.perf_counter()
+        try:
+            results = list(consumer.consume(calls))
+            if len(results) != len(calls):
+                raise ValueError('Batching consumer %s returned %d results for %d calls.' % (
+                    consumer.name, len(results), len(calls)))
+            return [(ret, False) for ret in results]
+        except Exception as ex:
+            logger.exception(
+                'Error occurred when calling batching consumer. consumer: %s, batch size: %d',
+                consumer.name, len(calls))
+            return [(str(ex), True)] * len(calls)
+        finally:
+            consumer.metrics.handler.observe(time.perf_counter() - start)
+
+    def call_batch_consumer(self, consumer, batch):
+        """Run a batch of requests gathered by a MicroBatcher, then reply and ack
+        every request on its own. Requests whose deadline passed while they
+        waited for the batch are dropped.
+
+        """
+        live = []
+        for item in batch:
+            if expired(item[1]):
+                self.drop_expired(consumer, item[0])
+            else:
+                live.append(item)
+        if not live:
+            return
+        batch = live
+        started = time.time()
+        outcomes = self.run_batch_consumer(consumer, [(args, kwargs) for _, _, args, kwargs in batch])
+        ended = time.time()
+        for (delivery_tag, props, _, _), (ret, is_error) in zip(batch, outcomes):
+            self.stamp(props, HANDLER_START, started)
+            self.stamp(props, HANDLER_END, ended)
+            self.finish_call(consumer, delivery_tag, props, ret, is_error)
+
+    def call_batch_request(self, consumer, delivery_tag, props, calls):
+        """Run a batch request (see call_batch) on a batching consumer."""
+        outcomes = self.run_batch_consumer(consumer, calls)
+        self.stamp(props, HANDLER_END)
+        self.finish_call(consumer, delivery_tag, props, [[is_error, ret] for ret, is_error in outcomes], False)
+
+    def find_serializer(self, consumer, props):
+        """The serializer of a request. The reply is encoded with it too."""
+        if consumer.serializer is not None:
+            default = consumer.serializer
+        elif consumer.bJsonParameters:
+            default = 'json'
+        else:
+            default = serializers.DEFAULT_SERIALIZER
+        return serializers.find_serializer(props.content_type, default)
+
+    def reply_message(self, props, body, headers=None, is_error=False, serializer=None, compressor=None):
+        """Encode and publish a reply. A body the serializer can't encode, e.g.
+        a set in json, is replied as an error with the encoding error message.
+
+        :return: Whether the reply sent is an error
+
+        """
         if headers is None:
             headers = {}
+        if serializer is None:
+            serializer = serializers.find_serializer(props.content_type)
+        try:
+            body, content_encoding = self.encode_reply(body, serializer, compressor)
+        except Exception as ex:
+            logger.exception("Encoding a reply with serializer '%s' failed.", serializer.name)
+            body, content_encoding = self.encode_reply(
+                "Can't encode the result with serializer '%s': %s" % (serializer.name, ex), serializer, compressor)
+            is_error = True
+        self.publish_reply(props, body, serializer.content_type, content_encoding, headers, is_error)
+        return is_error
+
+    def encode_reply(self, body, serializer, compressor=None):
+        """Encode, then compress a reply body.
+
+        :rtype: tuple(bytes, content_encoding or None)
+
+        """
+        body = serializer.dumps(body)
+        if compressor is None:
+            return body, None
+        return compressor.compress(body)
+
+    def publish_reply(self, props, body, content_type, content_encoding, headers, is_error=False):
+        """Hand an encoded reply to the outbox."""
+        if SENT_AT in headers:
+            headers[REPLY_AT] = int(time.time() * 1000000)
 
         headers[ERROR_FLAG] = NO_ERROR if not is_error else HAS_ERROR
-        self._connection.ioloop.add_callback_threadsafe(partial(self._channel.basic_publish,
-                                                                    exchange=self._exchange,
-                                                                    routing_key=props.reply_to,
-                                                                    properties=pika.BasicProperties(
-                                                                        correlation_id=props.correlation_id,
-                                                                        headers=headers),
-                                                                    body=pickle.dumps(body)
-                                                                ))
+        if props.reply_to.startswith(Connector.DIRECT_REPLY_TO):
+            # Direct reply-to must be published through the default exchange
+            exchange = ''
+        else:
+            exchange = self._exchange
+        self._outbox.publish(exchange, props.reply_to,
+                             pika.BasicProperties(correlation_id=props.correlation_id,
+                                                  content_type=content_type,
+                                                  content_encoding=content_encoding,
+                                                  headers=headers),
+                             body)
 
-    def call_comsumer(self, consumer, delivery_tag, props, *args, **kwargs):
+    def run_consumer(self, consumer, args, kwargs, props=None):
+        """Call the consumer.
+
+        :param props: Properties of the request, stamped with the start and the
+                      end of the call
+        :rtype: tuple(result or error message, is_error)
+
+        """
+        if props is not None:
+            self.stamp(props, HANDLER_START)
+        start = time.perf_counter()
         try:
             ret = consumer.consume(*args, **kwargs)
-            is_error = False
+            if inspect.iscoroutine(ret):
+                # Holds the calling thread, see call_coroutine for the non-blocking way
+                ret = self._aioloop.run(ret)
+            return ret, False
+        except Exception as ex:
+            logger.exception(
+                'Error occurred when calling consumer. consumer: %s, args: %s, '
+                'kwargs: %s', consumer.name, args, kwargs)
+            return str(ex), True
+        finally:
+            consumer.metrics.handler.observe(time.perf_counter() - start)
+            if props is not None:
+                self.stamp(props, HANDLER_END)
+
+    def call_coroutine(self, consumer, delivery_tag, props, args, kwargs):
+        """Schedule a call of a coroutine consumer on the event loop and return
+        at once. The result is replied and acked from the loop thread.
+
+        """
+        try:
+            coro = consumer.consume(*args, **kwargs)
         except Exception as ex:
             logger.exception(
                 'Error occurred when calling consumer. consumer: %s, args: %s, '
                 'kwargs: %s', consumer.name, args, kwargs)
-            ret = str(ex)
+            self.finish_call(consumer, delivery_tag, props, str(ex), True)
+            return
+        future = self._aioloop.submit(self.timed_coroutine(consumer, coro, props))
+        future.add_done_callback(partial(self.finish_coroutine_call, consumer, delivery_tag, props, args, kwargs))
+
+    async def timed_coroutine(self, consumer, coro, props):
+        self.stamp(props, HANDLER_START)
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            consumer.metrics.handler.observe(time.perf_counter() - start)
+            self.stamp(props, HANDLER_END)
+
+    def finish_coroutine_call(self, consumer, delivery_tag, props, args, kwargs, future):
+        try:
+            ret, is_error = future.result(), False
+        except Exception as ex:
+            logger.error(
+                'Error occurred when calling consumer. consumer: %s, args: %s, '
+                'kwargs: %s', consumer.name, args, kwargs, exc_info=ex)
+            ret, is_error = str(ex), True
+        self.finish_call(consumer, delivery_tag, props, ret, is_error)
+
+    def call_comsumer(self, consumer, delivery_tag, props, *args, **kwargs):
+        ret, is_error = self.run_consumer(consumer, args, kwargs, props)
+        self.finish_call(consumer, delivery_tag, props, ret, is_error)
+
+    def finish_call(self, consumer, delivery_tag, props, ret, is_error):
+        """Reply the result if the caller waits for it, then ack the request.
+        The chunks of a generator are streamed if the caller asked for a stream,
+        otherwise they are collected into a list.
+
+        """
+        try:
+            if props.reply_to is not None and (props.headers or {}).get(STREAM_FLAG):
+                is_error = self.stream_reply(consumer, props, ret, is_error)
+            else:
+                if inspect.isgenerator(ret):
+                    ret, is_error = self.collect_generator(consumer, ret)
+                if props.reply_to is not None:
+                    start = time.perf_counter()
+                    headers = self.timing_headers(props)
+                    if consumer.max_age is not None and not is_error:
+                        headers[MAX_AGE] = int(consumer.max_age * 1000)
+                    is_error = self.reply_message(props, ret, headers=headers, is_error=is_error,
+                                                  serializer=self.find_serializer(consumer, props),
+                                                  compressor=consumer.compressor)
+                    consumer.metrics.reply.observe(time.perf_counter() - start)
+        except Exception:
+            logger.exception('Replying a call of consumer %s failed.', consumer.name)
             is_error = True
+        finally:
+            # Acked whatever happened to the reply, so the delivery never holds its prefetch slot
+            (consumer.metrics.failed if is_error else consumer.metrics.succeeded).inc()
+            self.acknowledge_message(delivery_tag)
 
-        if props.reply_to is not None:
-            self.reply_message(props, ret, is_error=is_error)
+    def collect_generator(self, consumer, generator):
+        try:
+            return list(generator), False
+        except Exception as ex:
+            logger.exception('Error occurred when iterating consumer. consumer: %s', consumer.name)
+            return str(ex), True
 
-        self.acknowledge_message(delivery_tag)
+    def stream_reply(self, consumer, props, ret, is_error):
+        """Send every chunk of a generator as its own reply, then the end of
+        stream marker. Any other result is streamed as a single chunk. A chunk
+        that can't be encoded is replied as an error instead, which ends the
+        stream.
+
+        :return: Whether the stream ended with an error
+
+        """
+        serializer = self.find_serializer(consumer, props)
+        seq = 0
+        if not is_error:
+            chunks = ret if inspect.isgenerator(ret) else [ret]
+            try:
+                for chunk in chunks:
+                    if self.reply_message(props, chunk, headers={STREAM_SEQ: seq}, serializer=serializer,
+                                          compressor=consumer.compressor):
+                        # The chunk was replied as an encoding error, which ends the stream on the client
+                        return True
+                    seq += 1
+                ret = None
+            except Exception as ex:
+                logger.exception('Error occurred when streaming consumer. consumer: %s', consumer.name)
+                ret, is_error = str(ex), True
+        return self.reply_message(props, ret, headers={STREAM_SEQ: seq, STREAM_END: 1}, is_error=is_error,
+                                  serializer=serializer, compressor=consumer.compressor)
 
-    @ThreadAtomLock(ReplyLockName)
     def acknowledge_message(self, delivery_tag):
-        self._connection.ioloop.add_callback_threadsafe(partial(self._channel.basic_ack, delivery_tag))
-        # ret = self._channel.basic_ack(delivery_tag)
+        self._outbox.ack(delivery_tag)
 
     def __contains__(self, consumer_name):
         return consumer_name in self._registries
 
     def stop(self):
+        for batcher in self._batchers.values():
+            batcher.stop()
+        for name, executor in self._executors.items():
+            executor.shutdown()
+            _process_consumers.pop(id(self._registries.get(name)), None)
         self._executor.shutdown()
+        self._aioloop.stop()
@@ -3,6 +3,31 @@
 ERROR_FLAG = 'error'
 NO_ERROR = 0
 HAS_ERROR = 1
+# Header of a batch request, whose body is {'batch': [{'args': ..., 'kwargs': ...}, ...]}
+BATCH_FLAG = 'batch'
+# Header of a request whose result is streamed back. Every reply of the stream carries its sequence number in
+# STREAM_SEQ, and the last one, which carries no chunk, is flagged with STREAM_END.
+STREAM_FLAG = 'stream'
+STREAM_SEQ = 'stream_seq'
+STREAM_END = 'stream_end'
+# Header of a reply clients may cache for the given number of milliseconds
+MAX_AGE = 'max_age_ms'
+# Header of a request: the absolute time in milliseconds since the epoch after which the caller no longer waits
+DEADLINE = 'deadline_ms'
+# Header of a request: the time in microseconds since the epoch when the client published it
+SENT_AT = 'sent_at_us'
+# Headers of a reply to a request with SENT_AT, in microseconds since the epoch: the request was delivered to the server,
+# the function started and returned, and the reply was encoded and handed over to be published.
+RECV_AT = 'recv_at_us'
+HANDLER_START = 'handler_start_us'
+HANDLER_END = 'handler_end_us'
+REPLY_AT = 'reply_at_us'
+# Headers of a chunk of a request uploaded in several messages, see upload.py
+UPLOAD_ID = 'upload_id'
+UPLOAD_SEQ = 'upload_seq'
+UPLOAD_COUNT = 'upload_count'
+UPLOAD_OFFSET = 'upload_offset'
+UPLOAD_SIZE = 'upload_size'
 
 
 class RemoteFunctionError(Exception):
@@ -11,3 +36,15 @@ class RemoteFunctionError(Exception):
 
 class RemoteCallTimeout(Exception):
     pass
+
+
+class SerializerNotRegistered(Exception):
+    pass
+
+
+class UploadError(Exception):
+    pass
+
+
+class PublishNacked(Exception):
+    pass
@@ -3,7 +3,7 @@ import sys
 
 
 def main():
-    from rabbit_rpc.commands import ManageUtility
+    from rabbitmq_rpc.commands import ManageUtility
 
     manage = ManageUtility(sys.argv)
     manage.execute()
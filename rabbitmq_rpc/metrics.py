@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+'''
+Metrics of the consumers and the clients, and their exporters. Snapshots are plain dicts: server.metrics() and
+client.metrics.snapshot() are the in-process API, and PrometheusExporter serves them over HTTP in the Prometheus text
+format. Other exporters only need to read the snapshots.
+'''
+import bisect
+import logging
+import threading
+
+from .exceptions import SENT_AT, RECV_AT, HANDLER_START, HANDLER_END, REPLY_AT
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the buckets of the latency histograms
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+class Summary(object):
+    '''
+    Count, sum, min and max of observed values, e.g. durations in seconds.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        with self._lock:
+            self._observe(value)
+
+    def _observe(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'min': self.min,
+            'max': self.max,
+        }
+
+
+class Histogram(Summary):
+    '''
+    A Summary that also counts the values per bucket.
+    Parameters:
+        buckets: Sorted upper bounds of the buckets. Larger values are only counted in the +Inf bucket.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._observe(value)
+            self._counts[index] += 1
+
+    def _snapshot(self):
+        snapshot = super(Histogram, self)._snapshot()
+        # Cumulative counts, as in Prometheus
+        buckets = []
+        count = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self._counts):
+            count += n
+            buckets.append((bound, count))
+        snapshot['buckets'] = buckets
+        return snapshot
+
+
+class Counter(object):
+    '''
+    A count of events.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class ConsumerMetrics(object):
+    '''
+    Metrics of one consumer.
+        received: Requests delivered for the consumer.
+        succeeded, failed: Requests finished with a result or with an error.
+        expired: Requests dropped because their caller's deadline had passed.
+        queue_wait: Seconds from the publish by the client (sent_at_us header) to the delivery. Only meaningful when
+            the clocks of the clients and the server are synchronized.
+        decode: Seconds spent decompressing and deserializing requests.
+        handler: Seconds spent in the function.
+        reply: Seconds spent serializing and compressing replies and handing them over to the ioloop.
+    '''
+    def __init__(self):
+        self.received = Counter()
+        self.succeeded = Counter()
+        self.failed = Counter()
+        self.expired = Counter()
+        self.queue_wait = Histogram()
+        self.decode = Histogram()
+        self.handler = Histogram()
+        self.reply = Histogram()
+
+    def snapshot(self):
+        return {
+            'received': self.received.value,
+            'succeeded': self.succeeded.value,
+            'failed': self.failed.value,
+            'expired': self.expired.value,
+            'queue_wait': self.queue_wait.snapshot(),
+            'decode': self.decode.snapshot(),
+            'handler': self.handler.snapshot(),
+            'reply': self.reply.snapshot(),
+        }
+
+
+class ClientMetrics(object):
+    '''
+    Metrics of a client, per remote function.
+        calls, errors: Calls waited for, and those that failed on the server or timed out.
+        round_trip: Seconds from the publish of a request to the receipt of its reply.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._functions = {}
+
+    def _function(self, name):
+        metrics = self._functions.get(name)
+        if metrics is None:
+            with self._lock:
+                metrics = self._functions.setdefault(name, (Counter(), Counter(), Histogram()))
+        return metrics
+
+    def observe(self, name, seconds, is_error=False):
+        calls, errors, round_trip = self._function(name)
+        calls.inc()
+        if is_error:
+            errors.inc()
+        round_trip.observe(seconds)
+
+    def snapshot(self):
+        """Metrics of every remote function called, keyed by function name."""
+        with self._lock:
+            functions = list(self._functions.items())
+        return dict((name, {
+            'calls': calls.value,
+            'errors': errors.value,
+            'round_trip': round_trip.snapshot(),
+        }) for name, (calls, errors, round_trip) in functions)
+
+
+class CallTiming(object):
+    '''
+    Timestamps of one call, in seconds since the epoch, from the timing headers of its reply, and the durations
+    between them. The timestamps the server didn't send are None, and so are the durations depending on them.
+        sent_at: The client published the request.
+        recv_at: The request was delivered to the server.
+        handler_start, handler_end: The function started and returned.
+        reply_at: The reply was encoded and handed over to be published.
+        received_at: The client received the reply.
+    The durations between a client and a server timestamp are only meaningful if their clocks are synchronized.
+    '''
+    _HEADERS = ((SENT_AT, 'sent_at'), (RECV_AT, 'recv_at'), (HANDLER_START, 'handler_start'),
+                (HANDLER_END, 'handler_end'), (REPLY_AT, 'reply_at'))
+
+    def __init__(self, function=None, correlation_id=None, sent_at=None, recv_at=None, handler_start=None,
+                 handler_end=None, reply_at=None, received_at=None):
+        self.function = function
+        self.correlation_id = correlation_id
+        self.sent_at = sent_at
+        self.recv_at = recv_at
+        self.handler_start = handler_start
+        self.handler_end = handler_end
+        self.reply_at = reply_at
+        self.received_at = received_at
+
+    @classmethod
+    def from_headers(cls, headers, received_at, correlation_id=None):
+        timing = cls(correlation_id=correlation_id, received_at=received_at)
+        for header, attr in cls._HEADERS:
+            if headers.get(header) is not None:
+                setattr(timing, attr, headers[header] / 1000000.0)
+        return timing
+
+    @staticmethod
+    def _span(start, end):
+        if start is None or end is None:
+            return None
+        return end - start
+
+    @property
+    def queue(self):
+        """In the broker, from the publish to the delivery."""
+        return self._span(self.sent_at, self.recv_at)
+
+    @property
+    def dispatch(self):
+        """In the server before the function started: waiting for a thread, and decoding."""
+        return self._span(self.recv_at, self.handler_start)
+
+    @property
+    def handler(self):
+        return self._span(self.handler_start, self.handler_end)
+
+    @property
+    def reply(self):
+        """Encoding the result."""
+        return self._span(self.handler_end, self.reply_at)
+
+    @property
+    def return_trip(self):
+        """From the server handing the reply over to the client receiving it."""
+        return self._span(self.reply_at, self.received_at)
+
+    @property
+    def total(self):
+        return self._span(self.sent_at, self.received_at)
+
+    def breakdown(self):
+        """The durations in seconds, by name."""
+        return {
+            'queue': self.queue,
+            'dispatch': self.dispatch,
+            'handler': self.handler,
+            'reply': self.reply,
+            'return_trip': self.return_trip,
+            'total': self.total,
+        }
+
+    def __repr__(self):
+        spans = ', '.join('%s=%s' % (name, '%.6f' % value if value is not None else None)
+                          for name, value in sorted(self.breakdown().items()))
+        return '<CallTiming %s: %s>' % (self.function, spans)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render_prometheus(prefix, label, snapshots):
+    """Format snapshots in the Prometheus text format. Counters are named
+    <prefix>_<metric>_total, and latencies <prefix>_<metric>_seconds.
+
+    :param str prefix: Prefix of the metric names, e.g. rabbitmq_rpc_consumer
+    :param str label: Label of the keys of snapshots, e.g. consumer
+    :param dict snapshots: key -> {metric: int or Summary/Histogram snapshot}
+    :rtype: list of lines
+
+    """
+    families = {}
+    for key, metrics in sorted(snapshots.items()):
+        for metric, value in metrics.items():
+            families.setdefault(metric, []).append((key, value))
+    lines = []
+    for metric, values in sorted(families.items()):
+        if isinstance(values[0][1], dict):
+            name = '%s_%s_seconds' % (prefix, metric)
+            kind = 'histogram' if 'buckets' in values[0][1] else 'summary'
+        else:
+            name = '%s_%s_total' % (prefix, metric)
+            kind = 'counter'
+        lines.append('# TYPE %s %s' % (name, kind))
+        for key, value in values:
+            labels = '%s="%s"' % (label, str(key).replace('\\', '\\\\').replace('"', '\\"'))
+            if kind == 'counter':
+                lines.append('%s{%s} %d' % (name, labels, value))
+                continue
+            for bound, count in value.get('buckets', ()):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, _format_value(bound), count))
+            lines.append('%s_sum{%s} %s' % (name, labels, _format_value(value['sum'])))
+            lines.append('%s_count{%s} %d' % (name, labels, value['count']))
+    return lines
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PrometheusExporter(object):
+    '''
+    Serves metrics in the Prometheus text format on http://host:port/metrics, from a daemon thread.
+    Parameters:
+        port, host: Address to listen on. Port 0 picks a free port.
+    Usage:
+        exporter = PrometheusExporter(9100)
+        exporter.register('rabbitmq_rpc_consumer', 'consumer', server.metrics)
+        exporter.register('rabbitmq_rpc_client', 'function', client.metrics.snapshot)
+        exporter.start()
+    '''
+    def __init__(self, port=9100, host=''):
+        self.port = port
+        self.host = host
+        self._sources = []
+        self._httpd = None
+
+    def register(self, prefix, label, collect):
+        """Add a source of metrics.
+
+        :param str prefix: Prefix of its metric names
+        :param str label: Label of the keys of its snapshots
+        :param callable collect: Returns the snapshots, key -> {metric: value}
+
+        """
+        self._sources.append((prefix, label, collect))
+
+    def render(self):
+        lines = []
+        for prefix, label, collect in self._sources:
+            try:
+                lines.extend(render_prometheus(prefix, label, collect()))
+            except Exception:
+                logger.exception('Collecting the metrics of %s failed.', prefix)
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._httpd = _ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._httpd.server_address[1]
+        thread = threading.Thread(target=self._httpd.serve_forever, name='rabbitmq_rpc-metrics')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+Reply and ack handoff from the worker threads to the ioloop. Workers append to a deque, which needs no lock, and the
+ioloop is woken once to drain everything pending: replies are published back to back, then the acks are sent, the
+contiguous ones as a single basic_ack(multiple=True).
+'''
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+_REPLY = 0
+_ACK = 1
+
+
+class ReplyOutbox(object):
+    '''
+    The outbox of one channel, shared by every dispatcher consuming on it.
+    Parameters:
+        connection, channel: The pika connection and channel.
+        threaded: In threaded mode items are sent by the ioloop of the SelectConnection. Otherwise the caller is the
+            thread running the BlockingConnection, and items are sent at once.
+    '''
+    def __init__(self, connection, channel, threaded=True):
+        self._connection = connection
+        self._channel = channel
+        self._threaded = threaded
+        self._items = collections.deque()
+        self._scheduled = False
+        # Delivery tags not acked yet, in delivery order. Only touched on the ioloop thread.
+        self._unacked = collections.OrderedDict()
+        self.drains = 0
+        self.replies = 0
+        self.acks = 0
+        self.ack_frames = 0
+
+    def delivered(self, delivery_tag):
+        """Record a delivery. Called on the ioloop thread when the message is
+        received, so acks can be coalesced.
+
+        """
+        if self._threaded:
+            self._unacked[delivery_tag] = None
+
+    def publish(self, exchange, routing_key, properties, body):
+        if not self._threaded:
+            self._channel.basic_publish(exchange, routing_key, body, properties)
+            self.replies += 1
+            return
+        self._items.append((_REPLY, (exchange, routing_key, body, properties)))
+        self._wakeup()
+
+    def ack(self, delivery_tag):
+        if not self._threaded:
+            self._channel.basic_ack(delivery_tag)
+            self.acks += 1
+            self.ack_frames += 1
+            return
+        self._items.append((_ACK, delivery_tag))
+        self._wakeup()
+
+    def _wakeup(self):
+        # Cleared by drain() before it pops anything, so an item appended after
+        # the flag was seen set is always drained.
+        if not self._scheduled:
+            self._scheduled = True
+            self._connection.ioloop.add_callback_threadsafe(self.drain)
+
+    def drain(self):
+        """Send everything pending. Runs on the ioloop thread."""
+        self._scheduled = False
+        self.drains += 1
+        acks = set()
+        items = self._items
+        while True:
+            try:
+                kind, item = items.popleft()
+            except IndexError:
+                break
+            if kind == _REPLY:
+                try:
+                    self._channel.basic_publish(*item)
+                    self.replies += 1
+                except Exception:
+                    logger.exception('Publishing a reply failed.')
+            else:
+                acks.add(item)
+        if acks:
+            self._send_acks(acks)
+
+    def _send_acks(self, acks):
+        self.acks += len(acks)
+        # The oldest unacked deliveries that are all being acked go in one frame
+        last = None
+        unacked = self._unacked
+        while unacked:
+            tag = next(iter(unacked))
+            if tag not in acks:
+                break
+            unacked.popitem(last=False)
+            acks.discard(tag)
+            last = tag
+        try:
+            if last is not None:
+                self._channel.basic_ack(last, multiple=True)
+                self.ack_frames += 1
+            for tag in sorted(acks):
+                unacked.pop(tag, None)
+                self._channel.basic_ack(tag)
+                self.ack_frames += 1
+        except Exception:
+            logger.exception('Acking messages failed.')
+
+    @property
+    def idle(self):
+        """Whether every delivery was acked and nothing is pending."""
+        return not self._unacked and not self._items
+
+    def stats(self):
+        return {
+            'drains': self.drains,
+            'replies': self.replies,
+            'acks': self.acks,
+            'ack_frames': self.ack_frames,
+        }
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+import uuid
+from six.moves import queue
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import partial
+
+import pika
+
+from .client import BaseRPCClient
+from .confirms import ConfirmTracker
+from .exceptions import RemoteFunctionError, RemoteCallTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class PooledRPCClient(BaseRPCClient):
+    '''
+    Thread-safe RPC client. It owns one pika.SelectConnection driven by a background I/O thread. call_<name> can be
+    used from any thread: the request is encoded in the calling thread, handed to the I/O thread to publish, and the
+    reply is routed back to the caller through a per-call waiter. Create one PooledRPCClient per process and share it
+    between threads instead of building a RPCClient per request.
+    Parameters:
+        connect_timeout: seconds to wait for the connection to be ready. Default None, wait forever.
+        confirm_delivery: Put the channel in publisher confirm mode. Publishes don't wait for their confirm: a call
+            with '__ignore_result' returns a concurrent.futures.Future resolved when the broker confirmed the request,
+            or failed with PublishNacked. wait_for_confirms() waits for every request published so far.
+        max_in_flight: With confirm_delivery, max number of unconfirmed messages. Publishing blocks past it, for at
+            most the call's '__timeout'.
+        Other parameters: See RPCClient
+    '''
+    def __init__(self, connect_timeout=None, confirm_delivery=False, max_in_flight=1000, **kwargs):
+        super(PooledRPCClient, self).__init__(**kwargs)
+        self._threaded = True
+        self._waiters = {}
+        self._confirms = ConfirmTracker(max_in_flight) if confirm_delivery else None
+        self._ready = threading.Event()
+        self._error = None
+        self._connection = self.connect()
+        self._io_thread = threading.Thread(target=self._connection.ioloop.start, name='rabbitmq_rpc-io')
+        self._io_thread.daemon = True
+        self._io_thread.start()
+        if not self._ready.wait(connect_timeout):
+            self.close()
+            raise RemoteCallTimeout('Connecting to rabbitmq server timeout.')
+        if self._error is not None:
+            raise self._error
+
+    def connect(self):
+        return pika.SelectConnection(
+            self.conn_parameters,
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed)
+
+    def on_connection_open_error(self, unused_connection, err):
+        logger.error('Connection open failed: %s', err)
+        self._error = err if isinstance(err, BaseException) else Exception(err)
+        self._connection.ioloop.stop()
+        self._ready.set()
+
+    def on_connection_closed(self, unused_connection, reason):
+        self._channel = None
+        if not self._closing:
+            logger.info('Connection was closed unexpected: %s', reason)
+        self._error = pika.exceptions.ConnectionClosed(320, str(reason))
+        waiters, self._waiters = self._waiters, {}
+        for waiter in waiters.values():
+            if isinstance(waiter, queue.Queue):
+                waiter.put(self._error)
+            elif not waiter.done():
+                waiter.set_exception(self._error)
+        if self._confirms is not None:
+            self._confirms.fail(self._error)
+        self._connection.ioloop.stop()
+        self._ready.set()
+
+    def on_channel_closed(self, channel, reason):
+        logger.info('Channel closed: %s', reason)
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self.close_connection()
+
+    def on_exchange_declareok(self, unused_frame):
+        if self._confirms is not None:
+            self._channel.confirm_delivery(self._confirms.on_delivery_confirmation,
+                                           callback=lambda unused_frame: self.setup_callback_queue())
+        else:
+            self.setup_callback_queue()
+
+    def setup_callback_queue(self):
+        if self.direct_reply_to:
+            self.callback_queue = self.DIRECT_REPLY_TO
+            self.on_callback_queue_bindok(None)
+            return
+        self._channel.queue_declare(queue="", exclusive=False, auto_delete=True,
+                                    callback=self.on_callback_queue_declareok)
+
+    def on_callback_queue_declareok(self, method_frame):
+        self.callback_queue = method_frame.method.queue
+        self._channel.queue_bind(self.callback_queue, self._exchange, callback=self.on_callback_queue_bindok)
+
+    def on_callback_queue_bindok(self, unused_frame):
+        self._channel.basic_consume(self.callback_queue, self.on_response, auto_ack=True,
+                                    callback=lambda unused_frame: self._ready.set())
+
+    def on_response(self, channel, basic_deliver, props, body):
+        # Runs in the I/O thread, decoding is left to the waiting thread.
+        waiter = self._waiters.get(props.correlation_id)
+        if isinstance(waiter, queue.Queue):
+            waiter.put((props, body))
+        elif waiter is not None and not waiter.done():
+            waiter.set_result((props, body))
+
+    def _check_connection(self):
+        if self._error is not None:
+            raise self._error
+        if self._closing:
+            raise pika.exceptions.ConnectionWrongStateError('Client has been closed.')
+
+    def publish_message(self, exchange, routing_key, body, ignore_result = False, headers=None, serializer=None,
+                        stream=False, priority=None):
+        return self.publish_request(exchange, routing_key, body, ignore_result, headers, serializer, stream,
+                                    priority=priority)[0]
+
+    def publish_request(self, exchange, routing_key, body, ignore_result = False, headers=None, serializer=None,
+                        stream=False, timeout=None, priority=None):
+        """Encode a request and hand it to the I/O thread to publish.
+
+        :param float timeout: With confirm_delivery, max seconds to wait for
+                              room in the in-flight window
+        :rtype: tuple(correlation id, Future of the publisher confirm or None)
+
+        """
+        self._check_connection()
+        serializer = self.get_serializer(serializer)
+        corr_id = str(uuid.uuid4())
+        body, content_encoding = self.compressor.compress(serializer.dumps(body))
+        chunks = self.split_request(body, headers)
+        expiration = self.request_expiration(headers, chunks)
+        messages = [(chunk, pika.BasicProperties(
+            reply_to=self.callback_queue if not ignore_result else None,
+            headers=chunk_headers,
+            correlation_id=corr_id,
+            content_type=serializer.content_type,
+            content_encoding=content_encoding,
+            expiration=expiration,
+            priority=priority,
+        )) for chunk, chunk_headers in chunks]
+
+        confirm = None
+        if self._confirms is not None:
+            self._confirms.acquire(len(messages), timeout)
+            confirm = Future()
+        if not ignore_result:
+            self._waiters[corr_id] = queue.Queue() if stream else Future()
+        self._connection.ioloop.add_callback_threadsafe(
+            partial(self._basic_publish, exchange, routing_key, messages, confirm))
+        return corr_id, confirm
+
+    def _basic_publish(self, exchange, routing_key, messages, confirm):
+        # Runs in the I/O thread
+        published = 0
+        try:
+            for body, properties in messages:
+                self._channel.basic_publish(exchange, routing_key, body, properties)
+                published += 1
+        except Exception as ex:
+            logger.error('Publish failed: %s', ex)
+            if confirm is not None:
+                confirm.set_exception(ex)
+        if self._confirms is not None:
+            if published:
+                self._confirms.register(confirm, published)
+            if published < len(messages):
+                self._confirms.release(len(messages) - published)
+
+    def wait_for_confirms(self, timeout=None):
+        """Wait until the broker confirmed every message published so far.
+        Needs confirm_delivery.
+
+        :return: False if the broker nacked a message since the last wait
+        :raises RemoteCallTimeout: Not confirmed within timeout seconds
+
+        """
+        if self._confirms is None:
+            raise ValueError('PooledRPCClient was created without confirm_delivery.')
+        return self._confirms.wait(timeout)
+
+    def confirm_stats(self):
+        return self._confirms.stats() if self._confirms is not None else {}
+
+    def get_response(self, correlation_id, timeout=None):
+        waiter = self._waiters.get(correlation_id)
+        if waiter is None:
+            self._check_connection()
+            raise RemoteCallTimeout()
+        try:
+            props, body = waiter.result(timeout)
+        except FutureTimeoutError:
+            raise RemoteCallTimeout()
+        finally:
+            self._waiters.pop(correlation_id, None)
+        return self.decode_response(props, body)
+
+    def get_stream(self, correlation_id, timeout=None):
+        """Iterate over the chunks of a streamed reply."""
+        replies = self._waiters[correlation_id]
+
+        def next_reply(timeout):
+            try:
+                reply = replies.get(timeout=timeout)
+            except queue.Empty:
+                raise RemoteCallTimeout()
+            if isinstance(reply, BaseException):
+                raise reply
+            return reply
+
+        try:
+            for chunk in self.iter_stream(next_reply, timeout):
+                yield chunk
+        finally:
+            self._waiters.pop(correlation_id, None)
+
+    def call(self, consumer_name):
+
+        def func(*args, **kwargs):
+            """Call the remote function. The options are the same as RPCClient.call.
+            With confirm_delivery, a call ignoring its result returns the Future
+            of its publisher confirm.
+            """
+            options = self.pop_call_options(kwargs)
+            key = self.cache_key(consumer_name, args, kwargs, options)
+            if key is not None:
+                found, ret = self._caches[consumer_name].get(key)
+                if found:
+                    return ret
+
+            payload = {
+                'args': args,
+                'kwargs': kwargs,
+            }
+            start = time.perf_counter()
+            corr_id, confirm = self.publish_request(
+                options['exchange'],
+                options['routing_key'],
+                body=payload,
+                ignore_result=options['ignore_result'],
+                headers=self.request_headers(consumer_name, options),
+                serializer=options['serializer'],
+                stream=options['stream'],
+                timeout=options['timeout'],
+                priority=options['priority'])
+
+            logger.debug('Sent remote call: %s', consumer_name)
+            if not options['ignore_result'] and options['stream']:
+                return self.get_stream(corr_id, options['timeout'])
+            if not options['ignore_result']:
+                if key is not None:
+                    self._cache_max_ages[corr_id] = None
+                self._timings[corr_id] = None
+                # Whatever the call raises counts as an error
+                is_error = True
+                try:
+                    ret = self.get_response(corr_id, options['timeout'])
+                    is_error = isinstance(ret, RemoteFunctionError)
+                except RemoteCallTimeout:
+                    raise RemoteCallTimeout(
+                        "Calling remote function '%s' timeout." % consumer_name)
+                finally:
+                    self.metrics.observe(consumer_name, time.perf_counter() - start, is_error)
+                    max_age = self._cache_max_ages.pop(corr_id, None)
+                    self.report_timing(consumer_name, corr_id)
+                if key is not None:
+                    self.store_cached(consumer_name, key, ret, max_age)
+
+                if isinstance(ret, RemoteFunctionError):
+                    raise ret
+
+                return ret
+            return confirm
+
+        func.__name__ = consumer_name
+        return func
+
+    def close(self):
+        """Close the connection and wait for the I/O thread to exit."""
+        if self._closing:
+            return
+        self._closing = True
+        if self._io_thread.is_alive():
+            self._connection.ioloop.add_callback_threadsafe(self.close_connection)
+            if threading.current_thread() is not self._io_thread:
+                self._io_thread.join()
+
+    def close_connection(self):
+        if self._connection.is_closing or self._connection.is_closed:
+            self._connection.ioloop.stop()
+        else:
+            self._connection.close()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+'''
+Pre-fork process supervisor. Python consumers are bound by the GIL, so one server process uses one core. Prefork runs
+one RPCServer per child process, each with its own connection, restarts the children that exit and forwards SIGTERM to
+them for a graceful shutdown.
+
+Import the consumers before Prefork.run(), so the children share the pages of the imported modules.
+'''
+import logging
+import os
+import signal
+import sys
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class Prefork(object):
+    '''
+    Parameters:
+        server_factory: Callable returning a new RPCServer. It's called in each child after the fork, so no
+            connection is shared between processes.
+        processes: Number of children.
+        max_requests: A child exits after max_requests requests and is replaced by a new one, which caps memory
+            growth. Default None, never.
+        restart_delay: Seconds to wait before replacing a child that crashed.
+    '''
+    def __init__(self, server_factory, processes=None, max_requests=None, restart_delay=1.0):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Prefork needs os.fork, which this platform does not provide.')
+        self.server_factory = server_factory
+        self.processes = processes or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.restart_delay = restart_delay
+        self._children = {}
+        self._stopping = False
+
+    def run(self):
+        """Start the children and supervise them until SIGTERM or SIGINT."""
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        logger.info('Starting %d worker processes..', self.processes)
+        while True:
+            while not self._stopping and len(self._children) < self.processes:
+                self._spawn()
+            if not self._children:
+                break
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if self._children.pop(pid, None) is None:
+                continue
+            crashed = not (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+            if crashed:
+                logger.error('Worker %d died with status %d.', pid, status)
+            else:
+                logger.info('Worker %d exited.', pid)
+            if crashed and not self._stopping:
+                time.sleep(self.restart_delay)
+        logger.info('All worker processes exited.')
+
+    def _spawn(self):
+        # Signals are blocked across the fork, so the child never runs the handler of the parent
+        signals = {signal.SIGTERM, signal.SIGINT}
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.time()
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            return
+        # In the child
+        status = 1
+        try:
+            self._children = {}
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            server = self.server_factory()
+            if self.max_requests:
+                server.max_requests = self.max_requests
+            server.handle_signals()
+            server.run()
+            status = 1 if server.connection_lost is not None else 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _on_signal(self, signum, frame):
+        if not self._stopping:
+            logger.info('Stopping worker processes..')
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
@@ -3,10 +3,12 @@
 
 class Queue(object):
 
-    def __init__(self, name, dispatcher, exclusive=False):
+    def __init__(self, name, dispatcher, exclusive=False, prefetch_count=None):
         self.name = name
         self.exclusive = exclusive
         self.dispatcher = dispatcher
+        # Unacked messages delivered to the consumer of the queue, None for the default of the server
+        self.prefetch_count = prefetch_count
 
     def add_consumer(self, consumer):
         return self.dispatcher.register(consumer)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+Serializer registry. Every serializer is registered under a short name and the AMQP content_type it produces.
+Requests carry the content_type of their body, and the server decodes them and encodes the reply with the
+same serializer, so a reply always comes back in the requester's format.
+
+Builtin serializers:
+    pickle: 'application/x-python-serialize', pickle with the highest protocol available.
+    json: 'application/json'
+    msgpack: 'application/x-msgpack', only if msgpack is installed. Tuples come back as lists.
+    pickle5: 'application/x-python-serialize-oob', pickle protocol 5 with out-of-band buffers (python>=3.8).
+        Large contiguous buffers (bytes-like objects, NumPy arrays...) are appended to the body as raw frames instead
+        of being pickled, and are rebuilt as read-only views over the received body. Only decoding saves a copy:
+        encoding still copies the buffers once, into the body.
+'''
+import json
+import pickle
+import struct
+
+from .exceptions import SerializerNotRegistered
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DEFAULT_SERIALIZER = 'pickle'
+# Buffers smaller than this stay in the pickle stream of 'pickle5'
+OOB_MIN_SIZE = 64 * 1024
+
+
+class Serializer(object):
+
+    def __init__(self, name, content_type, dumps, loads):
+        self.name = name
+        self.content_type = content_type
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return '<Serializer %s: %s>' % (self.name, self.content_type)
+
+
+_serializers = {}
+
+
+def register(name, content_type, dumps, loads):
+    """Register a serializer. It can be looked up later either by name or by
+    content_type.
+
+    :param str name: Short name of the serializer, e.g. 'json'
+    :param str content_type: The AMQP content_type of the encoded bodies
+    :param callable dumps: obj -> bytes
+    :param callable loads: bytes -> obj
+
+    """
+    serializer = Serializer(name, content_type, dumps, loads)
+    _serializers[name] = serializer
+    _serializers[content_type] = serializer
+    return serializer
+
+
+def unregister(name):
+    serializer = _serializers.pop(name, None)
+    if serializer is not None:
+        _serializers.pop(serializer.content_type, None)
+        _serializers.pop(serializer.name, None)
+
+
+def get_serializer(name):
+    """Find a serializer by name or content_type. A Serializer object is
+    returned as is.
+
+    :raises SerializerNotRegistered: if nothing is registered under name
+
+    """
+    if isinstance(name, Serializer):
+        return name
+    try:
+        return _serializers[name]
+    except KeyError:
+        raise SerializerNotRegistered("Serializer '%s' is not registered." % name)
+
+
+def find_serializer(content_type, default=DEFAULT_SERIALIZER):
+    """Serializer of a received message. Messages without content_type, or with
+    an unknown one, are decoded with default.
+
+    """
+    if content_type and content_type in _serializers:
+        return _serializers[content_type]
+    return get_serializer(default)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _json_loads(body):
+    return json.loads(bytes(body).decode('utf-8'))
+
+
+def _pickle_dumps(obj):
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+register('pickle', 'application/x-python-serialize', _pickle_dumps, pickle.loads)
+register('json', 'application/json', _json_dumps, _json_loads)
+
+if msgpack is not None:
+    def _msgpack_dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _msgpack_loads(body):
+        return msgpack.unpackb(body, raw=False)
+
+    register('msgpack', 'application/x-msgpack', _msgpack_dumps, _msgpack_loads)
+
+if pickle.HIGHEST_PROTOCOL >= 5:
+    # Body layout: [count: uint32][pickle length, buffer lengths...: uint64 * (count + 1)][pickle][buffers...]
+    def _pickle_oob_dumps(obj):
+        buffers = []
+
+        def buffer_callback(buf):
+            raw = buf.raw()
+            if raw.nbytes < OOB_MIN_SIZE:
+                return True
+            buffers.append(raw)
+            return False
+
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+        lengths = [len(data)] + [raw.nbytes for raw in buffers]
+        header = struct.pack('!I%dQ' % len(lengths), len(buffers), *lengths)
+        # pika publishes one bytes body, so the buffers are copied into it once
+        return b''.join([header, data] + buffers)
+
+    def _pickle_oob_loads(body):
+        view = memoryview(body)
+        count, = struct.unpack_from('!I', view)
+        offset = 4 + 8 * (count + 1)
+        lengths = struct.unpack_from('!%dQ' % (count + 1), view, 4)
+        data = view[offset:offset + lengths[0]]
+        offset += lengths[0]
+        buffers = []
+        for length in lengths[1:]:
+            buffers.append(view[offset:offset + length])
+            offset += length
+        return pickle.loads(data, buffers=buffers)
+
+    register('pickle5', 'application/x-python-serialize-oob', _pickle_oob_dumps, _pickle_oob_loads)
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+import inspect
 import logging
+import signal
+from functools import partial
 
 from .base import Connector
-from .consumer import MessageDispatcher,Consumer
+from .consumer import MessageDispatcher,Consumer,create_process_pool
 from .queue import Queue
+from .upload import UploadReassembler
+from .outbox import ReplyOutbox
+from .aioloop import EventLoopThread
 
 logger = logging.getLogger(__name__)
 
@@ -18,39 +24,111 @@ class RPCServer(Connector):
     host,port,username, passwd, exchange: Please refer to base class 'Connector'
     num_threads: If threaded==True, RPC server can run in multi-threads mode. Then you can specify max threads you want.
         Default -1, means automatically decide number of threads.
+    upload_spool_size: A chunked request (see RPCClient's upload_chunk_size) larger than upload_spool_size bytes is
+        reassembled in a temporary file instead of memory, and passed to the serializer as a mmap.
+    upload_memory_limit: Max bytes of all the chunked requests being reassembled in memory. Past it, new chunks go to
+        temporary files.
+    upload_max_size: Chunked requests larger than upload_max_size bytes are rejected. Default None, no limit.
+    accept_uploads: False rejects every chunked request with an error. The chunks of a request must all reach the
+        same server, so set it when several servers consume the queue, e.g. pre-forked workers.
+    max_requests: The server shuts down gracefully after max_requests requests, see shutdown(). Default None, never.
+    async_concurrency: Max number of calls of coroutine (async def) consumers running at once on the event loop. The
+        prefetch count of their queues is raised to it.
+    max_priority: Declare the queues with x-max-priority, so calls with a higher __priority are delivered first. The
+        requests waiting for a thread of the server are run by priority too. Default None, no priority queues.
+    queue_settings: dict of queue name -> dict of prefetch_count, num_threads and max_priority, to size the prefetch
+        count and the thread pool of each queue. By default the thread pool of a queue has num_threads threads, and in threaded mode
+        its prefetch count is twice the number of threads and processes running its consumers, so a worker that
+        finishes finds the next message already delivered. It's raised to the largest batch_size of the consumers of
+        the queue, and to async_concurrency if it has coroutine consumers. In blocking mode it's 1.
     '''
 
-    def __init__(self,queue_name = None, consumers = None, num_threads=-1, durable = False, auto_delete = True, *args, **kwargs):
+    def __init__(self,queue_name = None, consumers = None, num_threads=-1, durable = False, auto_delete = True, *args,
+                 upload_spool_size = 8 * 1024 * 1024, upload_memory_limit = 64 * 1024 * 1024, upload_max_size = None,
+                 max_requests = None, async_concurrency = 100, queue_settings = None,
+                 max_priority = None, accept_uploads = True, **kwargs):
         self._queues = {}
+        self.max_requests = max_requests
+        self.requests = 0
+        self._shutting_down = False
+        self._signaled = False
+        self._on_consuming = None
+        # Set to the reason if the connection was lost, instead of closed by stop()
+        self.connection_lost = None
+        self._uploads = UploadReassembler(upload_spool_size, upload_memory_limit, upload_max_size,
+                                          accept=accept_uploads)
+        self._outbox = None
+        # Pools of the executor='process' consumers, by consumer name, see run()
+        self._process_pools = {}
+        self._aioloop = EventLoopThread(async_concurrency)
         if consumers is None:
             self._consumers = []
         else:
             self._consumers = consumers
         self.default_queue = queue_name or self.DEFUALT_QUEUE
         self.num_threads =num_threads
+        self.queue_settings = queue_settings or {}
+        self.max_priority = max_priority
         if num_threads > 0:
             prefetch_count = num_threads
         else:
             prefetch_count = 1
         super(RPCServer, self).__init__(durable=durable, auto_delete=auto_delete,prefetch_count=prefetch_count,
                                         *args, **kwargs)
-    def consumer(self, name=None, queue=None, exclusive=False, bJsonArgs = False):
+    def consumer(self, name=None, queue=None, exclusive=False, bJsonArgs = False, **options):
+        '''
+        Register func as a consumer.
+        Parameters:
+            bJsonArgs: requests without content_type are decoded as json.
+            options: serializer, compression, batching... See consumer.Consumer.
+        '''
         def decorator(func):
             cname = name or func.__name__
-            c = Consumer(cname, queue, exclusive)
+            c = Consumer(cname, queue, exclusive, **options)
             c.consume = func
             c.bJsonParameters = bJsonArgs
             self._consumers.append(c)
             return func
         return decorator
 
+    def compression_stats(self):
+        """Compression counters of every consumer, keyed by consumer name."""
+        return dict((c.name, c.compressor.stats()) for c in self._consumers)
+
+    def metrics(self):
+        """Metrics of every consumer, keyed by consumer name. See metrics.py."""
+        return dict((c.name, c.metrics.snapshot()) for c in self._consumers)
+
+    def async_stats(self):
+        """Counters of the event loop of the coroutine consumers."""
+        return self._aioloop.stats()
+
+    def cache_stats(self):
+        """Result cache counters of every caching consumer, keyed by consumer name."""
+        return dict((c.name, c.cache.stats()) for c in self._consumers if c.cache is not None)
+
+    def invalidate_cache(self, name=None):
+        """Drop the cached results of consumer name, or of every consumer if
+        name is None.
+
+        """
+        for c in self._consumers:
+            if c.cache is not None and (name is None or c.name == name):
+                c.cache.invalidate()
+
     def on_exchange_declareok(self, unused_frame):
         self.setup_queues()
 
     def _setup_queue(self, queue_name):
+        if self._outbox is None:
+            # The dispatchers share the channel, so they share its outbox too
+            self._outbox = ReplyOutbox(self._connection, self._channel, self._threaded)
+        settings = self.queue_settings.get(queue_name, {})
         dispatcher = MessageDispatcher(self._connection, self._channel, self._exchange, threaded=self._threaded,
-                                       threadpool_size=self.num_threads)
-        queue = Queue(queue_name, dispatcher)
+                                       threadpool_size=settings.get('num_threads', self.num_threads),
+                                       uploads=self._uploads, outbox=self._outbox, aioloop=self._aioloop,
+                                       process_pools=self._process_pools)
+        queue = Queue(queue_name, dispatcher, prefetch_count=settings.get('prefetch_count'))
         self._queues[queue_name] = queue
         return queue
 
@@ -81,28 +159,61 @@ class RPCServer(Connector):
 
             queue.add_consumer(c)
 
+        for queue in self._queues.values():
+            if queue.prefetch_count is None:
+                queue.prefetch_count = self.queue_prefetch_count(queue)
+
         # setup the queue on RabbitMQ
         for queue_name in self._queues.keys():
-            self._channel.queue_declare(queue_name,  auto_delete=self.auto_delete, durable=self.durable)
+            max_priority = self.queue_settings.get(queue_name, {}).get('max_priority', self.max_priority)
+            arguments = {'x-max-priority': max_priority} if max_priority else None
+            self._channel.queue_declare(queue_name,  auto_delete=self.auto_delete, durable=self.durable,
+                                        arguments=arguments)
             self._channel.queue_bind(queue_name, exchange=self._exchange)
 
         self.start_consuming()
 
+    def queue_prefetch_count(self, queue):
+        """The default prefetch count of a queue, see queue_settings."""
+        if not self._threaded:
+            return self.prefetch_count
+        consumers = queue.dispatcher.consumers
+        counts = [2 * queue.dispatcher.workers]
+        # A batching consumer needs at least batch_size unacked messages to fill a batch, and coroutine consumers
+        # async_concurrency ones to fill the event loop
+        counts.extend(c.batch_size for c in consumers if c.batch_size)
+        if any(inspect.iscoroutinefunction(c.consume) for c in consumers):
+            counts.append(self._aioloop.concurrency)
+        return max(counts)
+
     def start_consuming(self):
         if self._threaded:
             self._channel.add_on_cancel_callback(self.on_consumer_cancelled)
         else:
             pass
         for queue in self._queues.values():
-            consumer_tag = self._channel.basic_consume(queue.name, queue.dispatcher)#, auto_ack=True)
+            # Without global_qos the prefetch count applies to the consumers started after it on the channel
+            self._channel.basic_qos(prefetch_count=queue.prefetch_count)
+            callback = queue.dispatcher if not self.max_requests else partial(self.on_message, queue.dispatcher)
+            consumer_tag = self._channel.basic_consume(queue.name, callback)#, auto_ack=True)
             queue.dispatcher.consumer_tag = consumer_tag
 
         logger.info(self._queues)
         logger.info('Start consuming..')
+        if self._on_consuming is not None:
+            self._on_consuming()
 
         if not self._threaded:
             self._channel.start_consuming()
 
+    def on_message(self, dispatcher, channel, basic_deliver, properties, body):
+        """Dispatch a message and count it against max_requests."""
+        dispatcher(channel, basic_deliver, properties, body)
+        self.requests += 1
+        if self.requests == self.max_requests:
+            logger.info('Served %d requests, shutting down..', self.requests)
+            self.shutdown()
+
     def on_consumer_cancelled(self, method_frame):
         """Invoked by pika when RabbitMQ sends a Basic.Cancel for a consumer
         receiving messages.
@@ -117,6 +228,9 @@ class RPCServer(Connector):
     def run(self):
         """Run by connecting and then starting the IOLoop."""
 
+        # Fork the process pools first, so the workers inherit neither the socket nor the ioloop thread
+        self._process_pools = dict((c.name, create_process_pool(c)) for c in self._consumers
+                                   if c.executor == 'process')
         # make sure one processor one connection
         if self._threaded:
             with self._lock:
@@ -127,6 +241,81 @@ class RPCServer(Connector):
             self._channel = self._connection.channel()
             self._channel.exchange_declare(self._exchange, exchange_type='direct', auto_delete=self.auto_delete, durable=self.durable)
             self.on_exchange_declareok(None)
+            if self._shutting_down:
+                for queue in self._queues.values():
+                    queue.dispatcher.stop()
+                self._closing = True
+                self._connection.close()
+
+    def _call_later(self, delay, callback):
+        if self._threaded:
+            return self._connection.ioloop.call_later(delay, callback)
+        return self._connection.call_later(delay, callback)
+
+    def handle_signals(self, signals=(signal.SIGTERM, signal.SIGINT), interval=0.5):
+        """Shut down gracefully on the given signals. The handler only sets a
+        flag, which is checked every interval seconds on the I/O thread. Call it
+        from the main thread, before run().
+
+        """
+        def on_signal(signum, frame):
+            self._signaled = True
+
+        def check():
+            if self._signaled:
+                logger.info('Signal received, shutting down..')
+                self.shutdown()
+            elif not self._closing:
+                self._call_later(interval, check)
+
+        for signum in signals:
+            signal.signal(signum, on_signal)
+        self._on_consuming = lambda: self._call_later(interval, check)
+
+    def shutdown(self):
+        """Stop consuming, let the requests in progress be replied and acked,
+        then close the connection. Runs on the I/O thread.
+
+        """
+        if self._shutting_down or self._closing:
+            return
+        self._shutting_down = True
+        if not self._threaded:
+            # start_consuming() returns once the current message is done, then run() closes
+            self._channel.stop_consuming()
+            return
+        tags = [queue.dispatcher.consumer_tag for queue in self._queues.values()
+                if queue.dispatcher.consumer_tag is not None]
+        if not tags:
+            self._wait_idle()
+            return
+        pending = set(tags)
+
+        def on_cancelok(consumer_tag, unused_frame):
+            # Nothing is delivered after the last Basic.CancelOk
+            pending.discard(consumer_tag)
+            if not pending:
+                self._wait_idle()
+
+        for tag in tags:
+            self._channel.basic_cancel(tag, callback=partial(on_cancelok, tag))
+
+    def _wait_idle(self):
+        if self._outbox is not None and not self._outbox.idle:
+            self._call_later(0.1, self._wait_idle)
+            return
+        for queue in self._queues.values():
+            queue.dispatcher.stop()
+        self._closing = True
+        self.close_channel()
+
+    def on_connection_closed(self, *args):
+        if not self._closing:
+            self.connection_lost = args[-1] if args else True
+            logger.error('Connection lost: %s', self.connection_lost)
+            # Return from run() instead of idling without a connection
+            self._closing = True
+        super(RPCServer, self).on_connection_closed(*args)
 
     def stop(self):
         """Cleanly shutdown the connection to RabbitMQ by stopping the consumer
@@ -2,6 +2,9 @@ import time
 import threading
 import queue
 import functools
+import heapq
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor
 
 class LockNames():
     names = {}
@@ -94,4 +97,63 @@ class ThreadPool(object):
     def join(self):
         while any(self._thread_in_pool):
             time.sleep(0.05)
-__all__ = ["ThreadAtomLock", "ThreadPool"]
+
+class PriorityExecutor(object):
+    '''
+    按优先级执行任务的线程池。
+    参数：
+        max_workers, thread_name_prefix: 同ThreadPoolExecutor
+    说明：
+        任务先放入堆中，每提交一个任务，同时向线程池提交一个跳板任务。跳板任务运行时从堆中取出当前优先级最高的任务执行，
+        因此排队中的任务总是高优先级先执行，相同优先级按提交顺序执行。
+    使用方法：
+        executor = PriorityExecutor(8)
+        future = executor.submit_priority(9, func, a, b)
+        executor.submit(func, a, b)   # 优先级为0
+    '''
+    def __init__(self, max_workers=None, thread_name_prefix=''):
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=thread_name_prefix)
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit_priority(self, priority, fn, *args, **kwargs):
+        future = Future()
+        entry = (-(priority or 0), next(self._counter), future, fn, args, kwargs)
+        with self._lock:
+            heapq.heappush(self._heap, entry)
+        try:
+            self._executor.submit(self._run_next)
+        except BaseException as e:
+            # 跳板任务提交失败（如已shutdown），堆中多出一个任务：移除本任务；若本任务已被其他跳板取走，则移除最后执行的任务
+            with self._lock:
+                dropped = entry if entry in self._heap else max(self._heap)
+                self._heap.remove(dropped)
+                heapq.heapify(self._heap)
+            if dropped is entry:
+                raise
+            dropped[2].set_exception(e)
+        return future
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_priority(0, fn, *args, **kwargs)
+
+    def _run_next(self):
+        with self._lock:
+            _, _, future, fn, args, kwargs = heapq.heappop(self._heap)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    @property
+    def pending(self):
+        return len(self._heap)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+__all__ = ["ThreadAtomLock", "ThreadPool", "PriorityExecutor"]
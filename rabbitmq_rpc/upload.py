@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+'''
+Chunked upload of large requests. A client with upload_chunk_size splits request bodies larger than that into chunk
+messages sharing one upload id, and the server reassembles them before the request is decoded.
+
+All the chunks of an upload have to reach the same server, so a queue receiving uploads should have a single
+consumer (e.g. declare it with 'x-single-active-consumer').
+'''
+import logging
+import mmap
+import tempfile
+import threading
+import time
+import uuid
+
+from .exceptions import UPLOAD_ID, UPLOAD_SEQ, UPLOAD_COUNT, UPLOAD_OFFSET, UPLOAD_SIZE, UploadError
+
+logger = logging.getLogger(__name__)
+
+
+def split_body(body, chunk_size):
+    """Split an encoded request body into upload chunks.
+
+    :param bytes body: The encoded request
+    :param int chunk_size: Max bytes per chunk. None or 0 never splits.
+    :rtype: list of (chunk, headers): headers is None if body isn't split
+
+    """
+    if not chunk_size or len(body) <= chunk_size:
+        return [(body, None)]
+    upload_id = uuid.uuid4().hex
+    count = (len(body) + chunk_size - 1) // chunk_size
+    view = memoryview(body)
+    chunks = []
+    for seq in range(count):
+        offset = seq * chunk_size
+        chunks.append((view[offset:offset + chunk_size], {
+            UPLOAD_ID: upload_id,
+            UPLOAD_SEQ: seq,
+            UPLOAD_COUNT: count,
+            UPLOAD_OFFSET: offset,
+            UPLOAD_SIZE: len(body),
+        }))
+    return chunks
+
+
+class _Upload(object):
+
+    def __init__(self, size, count, spool_size):
+        self.size = size
+        self.count = count
+        # Seqs of the chunks written, so a redelivered chunk isn't counted twice
+        self.seqs = set()
+        self.in_memory = 0
+        self.spool_size = spool_size
+        # Never rolled over on its own: write() and rollover() do it, so rolled is known
+        self.file = tempfile.SpooledTemporaryFile(max_size=0)
+        self.rolled = False
+        self.touched = time.time()
+
+    def rollover(self):
+        """Move the upload from memory into its temporary file."""
+        if not self.rolled:
+            self.file.rollover()
+            self.rolled = True
+
+    @property
+    def received(self):
+        return len(self.seqs)
+
+    def write(self, seq, offset, chunk):
+        if offset + len(chunk) > self.spool_size:
+            self.rollover()
+        self.file.seek(offset)
+        self.file.write(chunk)
+        self.seqs.add(seq)
+        self.touched = time.time()
+
+    def read(self):
+        """The reassembled body. An upload spooled to disk is returned as a
+        read-only mmap of its temporary file.
+
+        """
+        if not self.rolled:
+            self.file.seek(0)
+            body = self.file.read()
+            self.file.close()
+            return body
+        self.file.flush()
+        body = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        # The mapping outlives the (already unlinked) temporary file
+        self.file.close()
+        return body
+
+
+class UploadReassembler(object):
+    '''
+    Reassembles chunked requests of one server.
+    Parameters:
+        spool_size: An upload larger than spool_size bytes is moved from memory into a temporary file.
+        memory_limit: Max bytes held in memory by all the uploads in progress. When it would be exceeded, the upload
+            is moved into a temporary file.
+        max_size: Uploads larger than max_size bytes are rejected. Default None, no limit.
+        timeout: Uploads without any new chunk for timeout seconds are dropped.
+        accept: False rejects every upload, e.g. when the queue has several consumers and the chunks of an upload
+            would be split between them.
+    '''
+    def __init__(self, spool_size=8 * 1024 * 1024, memory_limit=64 * 1024 * 1024, max_size=None, timeout=300,
+                 accept=True):
+        self.spool_size = spool_size
+        self.memory_limit = memory_limit
+        self.max_size = max_size
+        self.timeout = timeout
+        self.accept = accept
+        self._uploads = {}
+        # Rejected uploads whose later chunks are ignored: upload id -> time of their last chunk
+        self._failed = {}
+        self._memory = 0
+        self._lock = threading.Lock()
+
+    @property
+    def memory(self):
+        """Bytes held in memory by the uploads in progress."""
+        return self._memory
+
+    def add(self, headers, chunk):
+        """Add a chunk.
+
+        :param dict headers: Headers of the chunk message
+        :param bytes chunk: Body of the chunk message
+        :return: The reassembled body when chunk is the last missing one,
+                 otherwise None
+        :raises UploadError: The upload is rejected. Its later chunks are then
+                 ignored, until none came for timeout seconds.
+
+        """
+        upload_id = headers[UPLOAD_ID]
+        count = headers[UPLOAD_COUNT]
+        size = headers[UPLOAD_SIZE]
+        with self._lock:
+            self._expire()
+            if upload_id in self._failed:
+                if self.timeout:
+                    # Forgotten once no chunk came for timeout seconds, see _expire
+                    self._failed[upload_id] = time.time()
+                elif headers[UPLOAD_SEQ] == count - 1:
+                    del self._failed[upload_id]
+                return None
+            upload = self._uploads.get(upload_id)
+            if upload is None:
+                if not self.accept:
+                    self._failed[upload_id] = time.time()
+                    raise UploadError('Chunked requests are not accepted: the chunks would be split between the '
+                                      'consumers of the queue.')
+                if self.max_size is not None and size > self.max_size:
+                    self._failed[upload_id] = time.time()
+                    raise UploadError('Upload of %d bytes exceeds the limit of %d bytes.' % (size, self.max_size))
+                upload = self._uploads[upload_id] = _Upload(size, count, self.spool_size)
+            elif headers[UPLOAD_SEQ] in upload.seqs:
+                # Redelivered
+                logger.debug('Ignored chunk %d of upload %s, already received.', headers[UPLOAD_SEQ], upload_id)
+                upload.touched = time.time()
+                return None
+            if not upload.rolled:
+                if self._memory + len(chunk) > self.memory_limit:
+                    upload.rollover()
+                    self._memory -= upload.in_memory
+                    upload.in_memory = 0
+            try:
+                upload.write(headers[UPLOAD_SEQ], headers[UPLOAD_OFFSET], chunk)
+            except Exception as ex:
+                self._drop(upload_id)
+                self._failed[upload_id] = time.time()
+                raise UploadError('Writing upload failed: %s' % ex)
+            if upload.rolled:
+                self._memory -= upload.in_memory
+                upload.in_memory = 0
+            else:
+                upload.in_memory += len(chunk)
+                self._memory += len(chunk)
+            if upload.received < upload.count:
+                return None
+            self._drop(upload_id)
+        return upload.read()
+
+    def _drop(self, upload_id):
+        upload = self._uploads.pop(upload_id)
+        self._memory -= upload.in_memory
+        return upload
+
+    def _expire(self):
+        if not self.timeout:
+            return
+        deadline = time.time() - self.timeout
+        for upload_id, upload in list(self._uploads.items()):
+            if upload.touched < deadline:
+                logger.warning('Upload %s timeout, %d of %d chunks received.', upload_id, upload.received,
+                               upload.count)
+                self._drop(upload_id).file.close()
+        for upload_id, touched in list(self._failed.items()):
+            if touched < deadline:
+                del self._failed[upload_id]
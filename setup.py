@@ -20,7 +20,7 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='rabbitmq-rpc',
     version='0.1.10',
-    packages=find_packages(),
+    packages=find_packages(exclude=('tests', 'tests.*', 'benchmarks', 'benchmarks.*')),
     include_package_data=True,
     description='A modified rabbit-rpc of https://github.com/MidTin/rabbit-rpc',
     long_description=README,
@@ -30,6 +30,9 @@ setup(
     url='https://github.com/liupgd/rabbitmq_rpc',
     license='MIT',
     install_requires=requires,
+    extras_require={
+        'msgpack': ['msgpack'],
+    },
     platforms = 'any',
     classifiers=[
         'License :: OSI Approved :: MIT License',
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''
+Stand-ins for the pika connection, channel and ioloop, so MessageDispatcher runs without a broker. The ioloop is a
+thread running its callbacks one at a time, as pika's does, and the channel records what is published and acked.
+'''
+import itertools
+import queue
+import threading
+import time
+
+import pika
+from pika import spec
+
+from rabbitmq_rpc import serializers
+from rabbitmq_rpc.compression import Compressor
+from rabbitmq_rpc.consumer import Consumer, MessageDispatcher
+from rabbitmq_rpc.exceptions import BATCH_FLAG, ERROR_FLAG, HAS_ERROR
+
+TIMEOUT = 5
+
+
+class FakeIOLoop(object):
+
+    def __init__(self):
+        self._callbacks = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='fake-ioloop')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    def _run(self):
+        while True:
+            callback = self._callbacks.get()
+            if callback is None:
+                return
+            callback()
+
+    def stop(self):
+        self._callbacks.put(None)
+        self._thread.join()
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.ioloop = FakeIOLoop()
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.published = []
+        self.acked = []
+        self._delivered = []
+        self._cond = threading.Condition()
+
+    def delivered(self, delivery_tag):
+        with self._cond:
+            self._delivered.append(delivery_tag)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        with self._cond:
+            self.published.append((exchange, routing_key, properties, bytes(body)))
+            self._cond.notify_all()
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        with self._cond:
+            if multiple:
+                tags = [tag for tag in self._delivered if tag <= delivery_tag and tag not in self.acked]
+            else:
+                tags = [delivery_tag]
+            self.acked.extend(tags)
+            self._cond.notify_all()
+
+    def wait(self, predicate, timeout=TIMEOUT):
+        with self._cond:
+            if not self._cond.wait_for(predicate, timeout):
+                raise AssertionError('Timeout: %d published, acked %s' % (len(self.published), self.acked))
+
+
+class Reply(object):
+    '''
+    A decoded reply published by the dispatcher.
+    '''
+    def __init__(self, routing_key, props, body):
+        self.routing_key = routing_key
+        self.props = props
+        self.headers = props.headers or {}
+        self.is_error = self.headers.get(ERROR_FLAG) == HAS_ERROR
+        body = Compressor().decompress(body, props.content_encoding)
+        self.value = serializers.find_serializer(props.content_type).loads(body)
+
+    def __repr__(self):
+        return '<Reply %s error=%s: %r>' % (self.props.correlation_id, self.is_error, self.value)
+
+
+def make_consumer(name, func, **options):
+    """A Consumer named name calling func."""
+    c = Consumer(name, **options)
+    c.consume = func
+    return c
+
+
+class DispatcherHarness(object):
+    '''
+    A MessageDispatcher on a fake connection. Requests are delivered through the fake ioloop, like pika does.
+    Parameters:
+        consumers: The consumers to register.
+        kwargs: Passed to MessageDispatcher.
+    '''
+    _tags = itertools.count(1)
+
+    def __init__(self, consumers=(), threaded=True, **kwargs):
+        self.connection = FakeConnection()
+        self.channel = FakeChannel()
+        self.dispatcher = MessageDispatcher(self.connection, self.channel, exchange='test', threaded=threaded,
+                                            **kwargs)
+        for consumer in consumers:
+            self.dispatcher.register(consumer)
+        self.delivery_tags = []
+
+    def deliver(self, props, body):
+        """Deliver a raw message, return its delivery tag."""
+        delivery_tag = next(self._tags)
+        self.delivery_tags.append(delivery_tag)
+        self.channel.delivered(delivery_tag)
+        deliver = spec.Basic.Deliver('ctag', delivery_tag, False, 'test', 'default')
+        self.connection.ioloop.add_callback_threadsafe(
+            lambda: self.dispatcher.dispatch_message(self.channel, deliver, props, body))
+        return delivery_tag
+
+    def call(self, consumer_name, *args, **kwargs):
+        """Deliver a call of consumer_name like a client does.
+
+        :param str __serializer: serializer of the request, default pickle
+        :param dict __headers: extra headers
+        :param __body: request body to encode instead of args and kwargs
+        :param bool __batch: args are the arguments of the calls of a batch
+        :param int __priority: AMQP priority of the request
+        :return: The correlation id of the call
+
+        """
+        serializer = serializers.get_serializer(kwargs.pop('__serializer', 'pickle'))
+        headers = {'consumer_name': consumer_name}
+        headers.update(kwargs.pop('__headers', {}))
+        priority = kwargs.pop('__priority', None)
+        body = kwargs.pop('__body', None)
+        if kwargs.pop('__batch', False):
+            headers[BATCH_FLAG] = 1
+            body = {'batch': [{'args': call, 'kwargs': {}} for call in args]}
+        elif body is None:
+            body = {'args': args, 'kwargs': kwargs}
+        correlation_id = 'call-%d' % next(self._tags)
+        props = pika.BasicProperties(reply_to='reply', correlation_id=correlation_id, headers=headers,
+                                     content_type=serializer.content_type, priority=priority)
+        self.deliver(props, serializer.dumps(body))
+        return correlation_id
+
+    @property
+    def replies(self):
+        return [Reply(routing_key, props, body) for _, routing_key, props, body in self.channel.published]
+
+    def replies_of(self, correlation_id):
+        return [reply for reply in self.replies if reply.props.correlation_id == correlation_id]
+
+    def reply_of(self, correlation_id, timeout=TIMEOUT):
+        """The reply of a call, waiting for it."""
+        self.channel.wait(lambda: any(props.correlation_id == correlation_id
+                                      for _, _, props, _ in self.channel.published), timeout)
+        return self.replies_of(correlation_id)[0]
+
+    def wait_replies(self, count, timeout=TIMEOUT):
+        self.channel.wait(lambda: len(self.channel.published) >= count, timeout)
+        return self.replies
+
+    def wait_acked(self, timeout=TIMEOUT):
+        """Wait until every delivery was acked."""
+        self.channel.wait(lambda: set(self.delivery_tags) <= set(self.channel.acked), timeout)
+        # Let the ioloop finish the drain in progress
+        deadline = time.time() + timeout
+        while not self.dispatcher._outbox.idle and time.time() < deadline:
+            time.sleep(0.001)
+        return self.channel.acked
+
+    def close(self):
+        self.dispatcher.stop()
+        self.connection.ioloop.stop()
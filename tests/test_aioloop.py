@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from rabbitmq_rpc.aioloop import EventLoopThread
+
+from .fakes import TIMEOUT
+
+
+class EventLoopThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoopThread(concurrency=4)
+        self.peak = 0
+
+    def tearDown(self):
+        self.loop.stop()
+
+    async def work(self):
+        self.peak = max(self.peak, self.loop.running)
+        await asyncio.sleep(0)
+
+    def test_counters_under_concurrent_submits(self):
+        def submit(unused):
+            return [self.loop.submit(self.work()) for _ in range(200)]
+
+        with ThreadPoolExecutor(8) as executor:
+            futures = [future for futures in executor.map(submit, range(8)) for future in futures]
+        for future in futures:
+            future.result(TIMEOUT)
+        stats = self.loop.stats()
+        self.assertEqual(stats['submitted'], 1600)
+        self.assertEqual(stats['running'], 0)
+        self.assertLessEqual(self.peak, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+import pika
+
+from rabbitmq_rpc.exceptions import BATCH_FLAG, DEADLINE
+
+from .fakes import DispatcherHarness, make_consumer
+
+
+def divide(a, b):
+    return a / b
+
+
+class BatchRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.harness = DispatcherHarness([make_consumer('divide', divide)])
+
+    def tearDown(self):
+        self.harness.close()
+
+    def test_results_in_input_order(self):
+        reply = self.harness.reply_of(self.harness.call('divide', (6, 3), (1, 0), (9, 3), __batch=True))
+        self.assertFalse(reply.is_error)
+        self.assertEqual(reply.value[0], [False, 2])
+        self.assertTrue(reply.value[1][0])
+        self.assertEqual(reply.value[2], [False, 3])
+        self.harness.wait_acked()
+
+    def test_empty_batch(self):
+        reply = self.harness.reply_of(self.harness.call('divide', __batch=True))
+        self.assertFalse(reply.is_error)
+        self.assertEqual(reply.value, [])
+
+    def test_malformed_envelope_is_replied_as_error(self):
+        headers = {BATCH_FLAG: 1}
+        calls = [self.harness.call('divide', __headers=headers, __body=[1, 2]),
+                 self.harness.call('divide', __headers=headers, __body={'batch': 'nope'})]
+        props = pika.BasicProperties(reply_to='reply', correlation_id='garbage',
+                                     headers={'consumer_name': 'divide', BATCH_FLAG: 1},
+                                     content_type='application/json')
+        self.harness.deliver(props, b'{not json')
+        for correlation_id in calls + ['garbage']:
+            reply = self.harness.reply_of(correlation_id)
+            self.assertTrue(reply.is_error)
+            self.assertIn('Malformed batch request', reply.value)
+        self.harness.wait_acked()
+
+
+class MicroBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+        def double(calls):
+            with self.lock:
+                self.batches.append(len(calls))
+            return [args[0] * 2 for args, kwargs in calls]
+
+        self.harness = DispatcherHarness([make_consumer('double', double, batch_size=4, batch_timeout_ms=50)])
+
+    def tearDown(self):
+        self.harness.close()
+
+    def test_requests_are_batched(self):
+        calls = [self.harness.call('double', i) for i in range(6)]
+        for i, correlation_id in enumerate(calls):
+            reply = self.harness.reply_of(correlation_id)
+            self.assertFalse(reply.is_error)
+            self.assertEqual(reply.value, i * 2)
+        self.harness.wait_acked()
+        # A full batch of 4, then the 2 left once the timeout runs out
+        self.assertEqual(sum(self.batches), 6)
+        self.assertLess(len(self.batches), 6)
+
+    def test_requests_expired_in_the_batch_are_dropped(self):
+        deadline = int(time.time() * 1000) + 20
+        expiring = self.harness.call('double', 1, __headers={DEADLINE: deadline})
+        kept = self.harness.call('double', 2)
+        # Flushed by the timeout, after the deadline
+        self.assertEqual(self.harness.reply_of(kept).value, 4)
+        self.harness.wait_acked()
+        self.assertEqual(self.harness.replies_of(expiring), [])
+        self.assertEqual(self.batches, [1])
+        self.assertEqual(self.harness.dispatcher._registries['double'].metrics.expired.value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from rabbitmq_rpc.cache import ResultCache, canonical_key, request_key
+from rabbitmq_rpc.consumer import RAW_KEY_MAX_SIZE, Consumer
+from rabbitmq_rpc.exceptions import MAX_AGE
+
+from .fakes import DispatcherHarness, make_consumer
+
+
+class CanonicalKeyTest(unittest.TestCase):
+
+    def test_equal_arguments_have_equal_keys(self):
+        self.assertEqual(canonical_key((1, [2, 3]), {'a': 1, 'b': {'x': 1, 'y': 2}}),
+                         canonical_key([1, (2, 3)], {'b': {'y': 2, 'x': 1}, 'a': 1}))
+        self.assertNotEqual(canonical_key((1,), {}), canonical_key((2,), {}))
+        self.assertNotEqual(canonical_key((1,), {}), canonical_key(('1',), {}))
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ResultCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_maxbytes(self):
+        cache = ResultCache(maxsize=None, maxbytes=1000)
+        cache.put('big', b'x' * 2000)
+        self.assertEqual(len(cache), 0)
+        cache.put('a', b'x' * 600)
+        cache.put('b', b'x' * 600)
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertTrue(cache.get('b')[0])
+
+    def test_ttl(self):
+        cache = ResultCache(ttl=0.05)
+        cache.put('a', 1)
+        self.assertTrue(cache.get('a')[0])
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_aliases_are_dropped_with_their_entry(self):
+        cache = ResultCache(maxsize=1)
+        cache.alias('raw-a', 'a', b'encoded-a', 9)
+        self.assertEqual(cache.get_alias('raw-a'), (False, None))
+        cache.put('a', 1)
+        cache.alias('raw-a', 'a', b'encoded-a', 9)
+        self.assertEqual(cache.get_alias('raw-a'), (True, b'encoded-a'))
+        self.assertEqual(cache.stats()['bytes'], 9)
+        cache.put('b', 2)
+        self.assertEqual(cache.get_alias('raw-a'), (False, None))
+        self.assertEqual(cache.stats()['bytes'], 0)
+        cache.alias('raw-b', 'b')
+        cache.invalidate()
+        self.assertEqual(cache.get_alias('raw-b'), (False, None))
+        self.assertEqual(cache.stats()['misses'], 0)
+
+    def test_alias_values_count_in_maxbytes(self):
+        cache = ResultCache(maxsize=None, maxbytes=1000)
+        cache.put('a', 1)
+        cache.alias('raw-a', 'a', b'x' * 600, 600)
+        cache.put('b', 2)
+        cache.alias('raw-b', 'b', b'x' * 600, 600)
+        self.assertEqual(cache.get_alias('raw-a'), (False, None))
+        self.assertTrue(cache.get_alias('raw-b')[0])
+
+    def test_request_key_depends_on_the_encoding(self):
+        self.assertEqual(request_key('application/json', None, b'[1]'), request_key('application/json', None, b'[1]'))
+        self.assertNotEqual(request_key('application/json', None, b'[1]'), request_key('application/json', 'gzip', b'[1]'))
+        self.assertNotEqual(request_key('application/json', None, b'[1]'), request_key('application/json', None, b'[2]'))
+
+
+class ConsumerCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        def square(x):
+            self.calls.append(x)
+            if x < 0:
+                raise ValueError(x)
+            return x * x
+
+        c = Consumer('square', cache=True, max_age=30)
+        c.consume = square
+        self.consumer = c
+        self.harness = DispatcherHarness([c])
+
+    def tearDown(self):
+        self.harness.close()
+
+    def test_hits_skip_the_function(self):
+        for _ in range(3):
+            reply = self.harness.reply_of(self.harness.call('square', 4))
+            self.assertEqual(reply.value, 16)
+            self.assertEqual(reply.headers[MAX_AGE], 30000)
+        self.assertEqual(self.calls, [4])
+        self.assertEqual(self.consumer.cache.stats()['hits'], 2)
+        self.harness.wait_acked()
+
+    def test_errors_are_not_cached(self):
+        for _ in range(2):
+            reply = self.harness.reply_of(self.harness.call('square', -1))
+            self.assertTrue(reply.is_error)
+            self.assertNotIn(MAX_AGE, reply.headers)
+        self.assertEqual(self.calls, [-1, -1])
+
+
+class IOLoopCacheHitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.threads = []
+
+        def square(x):
+            self.threads.append(threading.current_thread().name)
+            return x * x
+
+        self.consumer = make_consumer('square', square, cache=True)
+        # Its replies are compressed, so its compressor counts the replies encoded
+        self.table = make_consumer('table', lambda x: [x] * 1000, cache=True, compress_threshold=100, max_age=30)
+        self.length = make_consumer('length', len, cache=True)
+        block = make_consumer('block', lambda x: self.release.wait(10))
+        self.harness = DispatcherHarness([self.consumer, self.table, self.length, block], threadpool_size=1)
+
+    def tearDown(self):
+        self.release.set()
+        self.harness.close()
+
+    def test_hits_are_replied_while_the_pool_is_busy(self):
+        self.assertEqual(self.harness.reply_of(self.harness.call('square', 3)).value, 9)
+        self.harness.call('block', 1)
+        # The only thread is blocked, the same request is replied from the cache anyway
+        self.assertEqual(self.harness.reply_of(self.harness.call('square', 3)).value, 9)
+        self.assertEqual(self.consumer.cache.stats()['hits'], 1)
+        self.assertNotIn('fake-ioloop', self.threads)
+        self.release.set()
+        self.harness.wait_acked()
+
+    def test_equal_arguments_encoded_differently_are_decoded_on_the_pool(self):
+        self.assertEqual(self.harness.reply_of(self.harness.call('square', 3)).value, 9)
+        self.harness.call('block', 1)
+        json_call = self.harness.call('square', 3, __serializer='json')
+        time.sleep(0.1)
+        self.assertEqual(self.harness.replies_of(json_call), [])
+        self.release.set()
+        self.assertEqual(self.harness.reply_of(json_call).value, 9)
+        self.assertEqual(self.threads, [self.threads[0]])
+        # Now aliased to the entry too
+        self.release.clear()
+        self.harness.call('block', 1)
+        self.assertEqual(self.harness.reply_of(self.harness.call('square', 3, __serializer='json')).value, 9)
+        self.release.set()
+        self.harness.wait_acked()
+
+    def test_hits_on_the_ioloop_send_the_reply_encoded_before(self):
+        first = self.harness.reply_of(self.harness.call('table', 7))
+        self.assertEqual(self.table.compressor.compressed, 1)
+        self.harness.call('block', 1)
+        reply = self.harness.reply_of(self.harness.call('table', 7))
+        self.assertEqual(reply.value, [7] * 1000)
+        self.assertEqual(reply.props.content_encoding, first.props.content_encoding)
+        self.assertEqual(reply.headers[MAX_AGE], 30000)
+        self.assertEqual(self.table.compressor.compressed, 1)
+        self.release.set()
+        self.harness.wait_acked()
+        self.assertEqual(self.table.metrics.succeeded.value, 2)
+
+    def test_large_requests_are_looked_up_on_the_pool(self):
+        arg = 'x' * RAW_KEY_MAX_SIZE
+        self.assertEqual(self.harness.reply_of(self.harness.call('length', arg)).value, RAW_KEY_MAX_SIZE)
+        self.harness.call('block', 1)
+        correlation_id = self.harness.call('length', arg)
+        time.sleep(0.1)
+        self.assertEqual(self.harness.replies_of(correlation_id), [])
+        self.release.set()
+        self.assertEqual(self.harness.reply_of(correlation_id).value, RAW_KEY_MAX_SIZE)
+        self.assertEqual(self.length.cache.stats()['hits'], 1)
+        self.harness.wait_acked()
+
+
+if __name__ == '__main__':
+    unittest.main()
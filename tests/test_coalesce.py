@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from rabbitmq_rpc.consumer import Consumer
+
+from .fakes import DispatcherHarness, TIMEOUT
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+
+        def slow(x):
+            self.calls.append(x)
+            self.release.wait(TIMEOUT)
+            if x < 0:
+                raise ValueError(x)
+            return x + 1
+
+        c = Consumer('slow', coalesce=True)
+        c.consume = slow
+        self.harness = DispatcherHarness([c])
+
+    def tearDown(self):
+        self.release.set()
+        self.harness.close()
+
+    def wait_waiters(self, count):
+        deadline = time.time() + TIMEOUT
+        while sum(len(waiters) for waiters in self.harness.dispatcher._inflight.values()) < count:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.001)
+
+    def test_identical_calls_run_once(self):
+        calls = [self.harness.call('slow', 1) for _ in range(5)]
+        other = self.harness.call('slow', 2)
+        self.wait_waiters(6)
+        self.release.set()
+        for correlation_id in calls:
+            self.assertEqual(self.harness.reply_of(correlation_id).value, 2)
+        self.assertEqual(self.harness.reply_of(other).value, 3)
+        self.harness.wait_acked()
+        self.assertEqual(sorted(self.calls), [1, 2])
+        self.assertEqual(self.harness.dispatcher._inflight, {})
+
+    def test_errors_are_shared(self):
+        calls = [self.harness.call('slow', -1) for _ in range(3)]
+        self.wait_waiters(3)
+        self.release.set()
+        for correlation_id in calls:
+            self.assertTrue(self.harness.reply_of(correlation_id).is_error)
+        self.assertEqual(self.calls, [-1])
+        # The next call runs again
+        self.assertTrue(self.harness.reply_of(self.harness.call('slow', -1)).is_error)
+        self.assertEqual(self.calls, [-1, -1])
+
+    def test_streams_are_not_coalesced(self):
+        self.release.set()
+        calls = [self.harness.call('slow', 1, __headers={'stream': 1}) for _ in range(2)]
+        for correlation_id in calls:
+            self.harness.reply_of(correlation_id)
+        self.harness.wait_acked()
+        self.assertEqual(self.calls, [1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
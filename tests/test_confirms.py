@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from pika import frame, spec
+
+from rabbitmq_rpc.confirms import ConfirmTracker
+from rabbitmq_rpc.exceptions import PublishNacked, RemoteCallTimeout
+
+
+def ack(delivery_tag, multiple=False):
+    return frame.Method(1, spec.Basic.Ack(delivery_tag, multiple))
+
+
+def nack(delivery_tag, multiple=False):
+    return frame.Method(1, spec.Basic.Nack(delivery_tag, multiple))
+
+
+class ConfirmTrackerTest(unittest.TestCase):
+
+    def publish(self, tracker, count=1):
+        tracker.acquire(count)
+        future = Future()
+        tracker.register(future, count)
+        return future
+
+    def test_acks_resolve_futures(self):
+        tracker = ConfirmTracker()
+        futures = [self.publish(tracker) for _ in range(4)]
+        tracker.on_delivery_confirmation(ack(2))
+        self.assertEqual([future.done() for future in futures], [False, True, False, False])
+        tracker.on_delivery_confirmation(ack(3, multiple=True))
+        self.assertEqual([future.done() for future in futures], [True, True, True, False])
+        self.assertTrue(futures[0].result())
+        self.assertEqual(tracker.in_flight, 1)
+
+    def test_nack_fails_future(self):
+        tracker = ConfirmTracker()
+        future = self.publish(tracker)
+        tracker.on_delivery_confirmation(nack(1))
+        self.assertRaises(PublishNacked, future.result, 0)
+        self.assertFalse(tracker.wait(0))
+        self.assertTrue(tracker.wait(0))
+
+    def test_message_of_several_frames(self):
+        # A chunked upload is confirmed once all its chunks are
+        tracker = ConfirmTracker()
+        future = self.publish(tracker, 3)
+        tracker.on_delivery_confirmation(ack(2, multiple=True))
+        self.assertFalse(future.done())
+        tracker.on_delivery_confirmation(ack(3))
+        self.assertTrue(future.result(0))
+
+    def test_window_blocks_publishers(self):
+        tracker = ConfirmTracker(max_in_flight=2)
+        self.publish(tracker)
+        self.publish(tracker)
+        self.assertRaises(RemoteCallTimeout, tracker.acquire, 1, 0.05)
+        threading.Timer(0.05, tracker.on_delivery_confirmation, [ack(1)]).start()
+        start = time.time()
+        tracker.acquire(1, 1)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(tracker.in_flight, 2)
+
+    def test_fail_releases_everything(self):
+        tracker = ConfirmTracker()
+        futures = [self.publish(tracker) for _ in range(2)]
+        tracker.fail(ValueError('lost'))
+        for future in futures:
+            self.assertRaises(ValueError, future.result, 0)
+        self.assertEqual(tracker.in_flight, 0)
+        self.assertTrue(tracker.wait(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
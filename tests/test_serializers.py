@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from rabbitmq_rpc import serializers
+
+from .fakes import DispatcherHarness, make_consumer
+
+
+class SerializerTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        for name in ('pickle', 'json'):
+            serializer = serializers.get_serializer(name)
+            self.assertEqual(serializer.loads(serializer.dumps({'args': [1, 'a'], 'kwargs': {}})),
+                             {'args': [1, 'a'], 'kwargs': {}})
+
+    def test_lookup_by_content_type(self):
+        self.assertIs(serializers.get_serializer('application/json'), serializers.get_serializer('json'))
+        self.assertEqual(serializers.find_serializer(None, 'json').name, 'json')
+        self.assertRaises(serializers.SerializerNotRegistered, serializers.get_serializer, 'nope')
+
+
+class ReplyEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.harness = DispatcherHarness([
+            make_consumer('add', lambda a, b: a + b),
+            make_consumer('as_set', lambda a: {a}),
+            make_consumer('as_lambda', lambda a: lambda: a),
+            make_consumer('chunks', lambda a: (chunk for chunk in [a, {a}, a])),
+        ])
+
+    def tearDown(self):
+        self.harness.close()
+
+    def test_reply_in_request_format(self):
+        for name in ('pickle', 'json'):
+            reply = self.harness.reply_of(self.harness.call('add', 1, 2, __serializer=name))
+            self.assertEqual(reply.props.content_type, serializers.get_serializer(name).content_type)
+            self.assertFalse(reply.is_error)
+            self.assertEqual(reply.value, 3)
+
+    def test_unencodable_result_is_replied_as_error(self):
+        json_call = self.harness.call('as_set', 1, __serializer='json')
+        pickle_call = self.harness.call('as_lambda', 1)
+        for correlation_id in (json_call, pickle_call):
+            reply = self.harness.reply_of(correlation_id)
+            self.assertTrue(reply.is_error)
+            self.assertIn("Can't encode the result", reply.value)
+        self.harness.wait_acked()
+        self.assertTrue(self.harness.dispatcher._outbox.idle)
+        self.assertEqual(self.harness.dispatcher._registries['as_set'].metrics.failed.value, 1)
+
+    def test_unencodable_chunk_ends_stream(self):
+        correlation_id = self.harness.call('chunks', 1, __serializer='json', __headers={'stream': 1})
+        self.harness.wait_acked()
+        replies = self.harness.replies_of(correlation_id)
+        self.assertEqual([reply.is_error for reply in replies], [False, True])
+        self.assertEqual(replies[0].value, 1)
+
+    def test_unencodable_batch_item_is_replied_as_error(self):
+        correlation_id = self.harness.call('as_set', (1,), (2,), __serializer='json', __batch=True)
+        self.assertTrue(self.harness.reply_of(correlation_id).is_error)
+        self.harness.wait_acked()
+
+
+if __name__ == '__main__':
+    unittest.main()
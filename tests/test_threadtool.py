@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from rabbitmq_rpc.threadtool import PriorityExecutor
+
+
+class ShutDownExecutor(object):
+    '''
+    Stands in for the ThreadPoolExecutor of a PriorityExecutor. Keeps the first task, then fails like a shut down
+    pool, after running the kept task as if a worker had picked it up meanwhile.
+    '''
+    def __init__(self):
+        self.task = None
+
+    def submit(self, fn):
+        if self.task is None:
+            self.task = fn
+            return
+        self.task()
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+
+class PriorityExecutorTest(unittest.TestCase):
+
+    def test_submit_after_shutdown(self):
+        executor = PriorityExecutor(2)
+        executor.shutdown()
+        self.assertRaises(RuntimeError, executor.submit_priority, 5, int)
+        self.assertEqual(executor.pending, 0)
+
+    def test_failed_submit_of_a_task_already_run(self):
+        executor = PriorityExecutor(2)
+        executor._executor = ShutDownExecutor()
+        low = executor.submit_priority(1, str, 'low')
+        # The worker of the first task runs the higher priority one, the first is left without a worker
+        high = executor.submit_priority(9, str, 'high')
+        self.assertEqual(high.result(0), 'high')
+        self.assertRaises(RuntimeError, low.result, 0)
+        self.assertEqual(executor.pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import mmap
+import time
+import unittest
+
+import pika
+
+from rabbitmq_rpc import serializers
+from rabbitmq_rpc.consumer import Consumer
+from rabbitmq_rpc.exceptions import UPLOAD_SEQ, UploadError
+from rabbitmq_rpc.upload import UploadReassembler, split_body
+
+from .fakes import DispatcherHarness
+
+
+class UploadReassemblerTest(unittest.TestCase):
+
+    def test_small_body_is_not_split(self):
+        self.assertEqual(split_body(b'abc', 10), [(b'abc', None)])
+        self.assertEqual(split_body(b'abc', None), [(b'abc', None)])
+
+    def reassemble(self, reassembler, body, chunk_size, order=None):
+        chunks = split_body(body, chunk_size)
+        if order is not None:
+            chunks = [chunks[i] for i in order]
+        results = [reassembler.add(headers, bytes(chunk)) for chunk, headers in chunks]
+        self.assertTrue(all(result is None for result in results[:-1]))
+        return results[-1]
+
+    def test_chunks_in_any_order(self):
+        body = bytes(bytearray(range(256))) * 40
+        reassembler = UploadReassembler()
+        result = self.reassemble(reassembler, body, 1000)
+        # Kept in memory
+        self.assertIsInstance(result, bytes)
+        self.assertEqual(result, body)
+        order = list(reversed(range(11)))
+        self.assertEqual(bytes(self.reassemble(reassembler, body, 1000, order)), body)
+        self.assertEqual(reassembler.memory, 0)
+
+    def test_large_upload_is_spooled_to_disk(self):
+        body = b'x' * 10000
+        for reassembler in (UploadReassembler(spool_size=4096), UploadReassembler(memory_limit=2500)):
+            result = self.reassemble(reassembler, body, 1000)
+            # Returned as a mmap of the temporary file
+            self.assertIsInstance(result, mmap.mmap)
+            self.assertEqual(bytes(result), body)
+            self.assertEqual(reassembler.memory, 0)
+
+    def test_upload_over_max_size_is_rejected(self):
+        reassembler = UploadReassembler(max_size=1000)
+        chunks = split_body(b'x' * 3000, 1000)
+        self.assertRaises(UploadError, reassembler.add, chunks[0][1], bytes(chunks[0][0]))
+        # The other chunks are ignored
+        self.assertIsNone(reassembler.add(chunks[1][1], bytes(chunks[1][0])))
+        self.assertIsNone(reassembler.add(chunks[2][1], bytes(chunks[2][0])))
+
+    def test_redelivered_chunk_is_counted_once(self):
+        body = bytes(bytearray(range(256))) * 12
+        reassembler = UploadReassembler()
+        chunks = split_body(body, 1000)
+        self.assertEqual(len(chunks), 4)
+        for chunk, headers in chunks[:3] + chunks[:1]:
+            self.assertIsNone(reassembler.add(headers, bytes(chunk)))
+        self.assertEqual(reassembler.memory, 3000)
+        # Complete only once the missing chunk arrives
+        self.assertEqual(bytes(reassembler.add(chunks[3][1], bytes(chunks[3][0]))), body)
+        self.assertEqual(reassembler.memory, 0)
+
+    def test_rejected_upload_is_forgotten_after_timeout(self):
+        reassembler = UploadReassembler(max_size=1000, timeout=0.05)
+        chunks = split_body(b'x' * 3000, 1000)
+        self.assertRaises(UploadError, reassembler.add, chunks[0][1], bytes(chunks[0][0]))
+        self.assertIsNone(reassembler.add(chunks[1][1], bytes(chunks[1][0])))
+        # The last chunk is lost, the id is still dropped once no chunk came for timeout seconds
+        time.sleep(0.1)
+        chunk, headers = split_body(b'y' * 20, 10)[0]
+        self.assertIsNone(reassembler.add(headers, bytes(chunk)))
+        self.assertEqual(reassembler._failed, {})
+
+
+class UploadDispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        c = Consumer('size')
+        c.consume = lambda data: len(data)
+        self.harness = DispatcherHarness([c], uploads=UploadReassembler(spool_size=50000))
+
+    def tearDown(self):
+        self.harness.close()
+
+    def upload(self, data, chunk_size):
+        body = serializers.get_serializer('pickle').dumps({'args': (data,), 'kwargs': {}})
+        chunks = split_body(body, chunk_size)
+        for chunk, headers in chunks:
+            headers['consumer_name'] = 'size'
+            props = pika.BasicProperties(reply_to='reply', correlation_id='upload-%d' % len(data), headers=headers,
+                                         content_type='application/x-python-serialize')
+            self.harness.deliver(props, bytes(chunk))
+        return 'upload-%d' % len(data), len(chunks)
+
+    def test_chunked_request(self):
+        for size in (30000, 200000):
+            correlation_id, count = self.upload(b'a' * size, 8192)
+            self.assertGreater(count, 1)
+            reply = self.harness.reply_of(correlation_id)
+            self.assertFalse(reply.is_error)
+            self.assertEqual(reply.value, size)
+        # Every chunk is acked, and only the last one is replied
+        self.harness.wait_acked()
+        self.assertEqual(len(self.harness.replies), 2)
+        self.assertTrue(all(UPLOAD_SEQ not in reply.headers for reply in self.harness.replies))
+
+
+if __name__ == '__main__':
+    unittest.main()